@@ -1,13 +1,27 @@
 import json
+import re
+from weakref import WeakKeyDictionary, WeakValueDictionary
 
 from alchimia import TWISTED_STRATEGY
-from sqlalchemy import MetaData, Table, Column, String, Text, create_engine
-from sqlalchemy.schema import CreateTable
-from twisted.internet.defer import succeed
+from alchimia.engine import TwistedEngine
+from sqlalchemy import (
+    MetaData, Table, Column, String, Text, bindparam, cast, create_engine,
+    func, select, text)
+from sqlalchemy.engine import Engine
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.interfaces import IReactorCore, IReactorTime
+from twisted.python.failure import Failure
 
 
-def get_engine(conn_str, reactor):
-    return create_engine(conn_str, reactor=reactor, strategy=TWISTED_STRATEGY)
+def get_engine(conn_str, reactor, **kw):
+    """
+    Create an alchimia engine.
+
+    Any extra keyword parameters (``pool_size``, ``max_overflow``, etc.) are
+    passed to SQLAlchemy's ``create_engine()``.
+    """
+    return create_engine(
+        conn_str, reactor=reactor, strategy=TWISTED_STRATEGY, **kw)
 
 
 class TableMissingError(Exception):
@@ -23,19 +37,35 @@ class CollectionMissingError(Exception):
 
 
 class make_table(object):
+    """
+    Table specification for use as a :class:`TableCollection` class attribute.
+
+    The SQLAlchemy table for each collection instance is only built the first
+    time the attribute is accessed on that instance, after which it is stored
+    in the instance dict.
+    """
+
     def __init__(self, *args, **kw):
         self.args = args
         self.kw = kw
+        # Columns can only belong to one table, so these need to be copied
+        # for each table we build.
+        self._column_positions = tuple(
+            i for i, arg in enumerate(args) if isinstance(arg, Column))
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._build_table(self)
 
     def make_table(self, name, metadata):
         return Table(name, metadata, *self.copy_args(), **self.kw)
 
     def copy_args(self):
-        for arg in self.args:
-            if isinstance(arg, Column):
-                yield arg.copy()
-            else:
-                yield arg
+        args = list(self.args)
+        for i in self._column_positions:
+            args[i] = args[i].copy()
+        return args
 
 
 def _false_to_error(result, err):
@@ -44,6 +74,21 @@ def _false_to_error(result, err):
     return result
 
 
+# These are module-level callbacks rather than lambdas so we don't build new
+# function objects for every query.
+
+def _call_ignoring_result(result, func, *args, **kw):
+    return func(*args, **kw)
+
+
+def _is_not_none(value):
+    return value is not None
+
+
+def _fetchall(result):
+    return result.fetchall()
+
+
 TABLE_EXISTS_ERR_TEMPLATES = (
     # SQLite
     'table %(name)s already exists',
@@ -57,42 +102,281 @@ TABLE_EXISTS_ERR_TEMPLATES = (
 )
 
 
+TABLE_MISSING_ERR_TEMPLATES = (
+    # SQLite
+    'no such table: %(name)s',
+    # PostgreSQL
+    'relation %(name)s does not exist',
+    'relation "%(name)s" does not exist',
+    # MySQL
+    "Table %(name)s doesn't exist",
+    "Table '%(name)s' doesn't exist",
+    # MySQL sometimes includes the database name.
+    ".%(name)s' doesn't exist",
+)
+
+
+def _build_pattern_template(err_templates):
+    """
+    Combine error templates into a single regex pattern, with a placeholder
+    for the (escaped) table name.
+    """
+    return '|'.join(
+        re.escape(err_template).replace(
+            re.escape('%(name)s'), '(?:%(name)s)(?!\\w)')
+        for err_template in err_templates)
+
+
+_TABLE_EXISTS_PATTERN_TEMPLATE = _build_pattern_template(
+    TABLE_EXISTS_ERR_TEMPLATES)
+_TABLE_MISSING_PATTERN_TEMPLATE = _build_pattern_template(
+    TABLE_MISSING_ERR_TEMPLATES)
+
+_error_regexes = {}
+
+
+def _table_name_variants(table_name):
+    # Sometimes the table name is lowercased in error messages.
+    lower_name = table_name.lower()
+    if lower_name == table_name:
+        return (table_name,)
+    return (table_name, lower_name)
+
+
+def _get_error_regex(pattern_template, table_name):
+    regex = _error_regexes.get((pattern_template, table_name))
+    if regex is None:
+        regex = re.compile(pattern_template % {
+            'name': '|'.join(
+                re.escape(name) for name in _table_name_variants(table_name)),
+        })
+        _error_regexes[(pattern_template, table_name)] = regex
+    return regex
+
+
+def _is_table_exists_error(table, err):
+    regex = _get_error_regex(_TABLE_EXISTS_PATTERN_TEMPLATE, table.name)
+    return regex.search(str(err)) is not None
+
+
+def _is_table_missing_error(table, err):
+    regex = _get_error_regex(_TABLE_MISSING_PATTERN_TEMPLATE, table.name)
+    return regex.search(str(err)) is not None
+
+
+def _make_metadata_upsert(table, dialect):
+    """
+    Build an "insert or update" statement for a collection metadata table.
+
+    The statement takes ``name`` and ``metadata_json`` parameters. If the
+    dialect has no suitable syntax, ``None`` is returned.
+    """
+    if dialect.name == 'sqlite':
+        return table.insert().prefix_with('OR REPLACE')
+
+    template = None
+    if dialect.name == 'mysql':
+        template = (
+            'INSERT INTO %s (name, metadata_json)'
+            ' VALUES (:name, :metadata_json)'
+            ' ON DUPLICATE KEY UPDATE metadata_json = VALUES(metadata_json)')
+    elif dialect.name == 'postgresql':
+        # ON CONFLICT is only available in PostgreSQL 9.5 and later.
+        if (dialect.server_version_info or ()) >= (9, 5):
+            template = (
+                'INSERT INTO %s (name, metadata_json)'
+                ' VALUES (:name, :metadata_json)'
+                ' ON CONFLICT (name)'
+                ' DO UPDATE SET metadata_json = EXCLUDED.metadata_json')
+    if template is None:
+        return None
+    return text(template % (dialect.identifier_preparer.format_table(table),))
+
+
+def _make_metadata_aggregate(table, dialect):
+    """
+    Build a statement that aggregates a whole collection metadata table into
+    a single JSON object mapping names to metadata JSON strings.
+
+    If the dialect has no suitable aggregate function, ``None`` is returned.
+    """
+    version = dialect.server_version_info or ()
+    if dialect.name == 'sqlite' and version >= (3, 38):
+        # JSON functions are only built in from SQLite 3.38.
+        agg_func = func.json_group_object
+    elif dialect.name == 'postgresql' and version >= (9, 4):
+        agg_func = func.json_object_agg
+    else:
+        return None
+    # PostgreSQL's aggregate returns a json value, which psycopg2 decodes for
+    # us. We want the string so we decode it the same way everywhere.
+    return select([
+        cast(agg_func(table.c.name, table.c.metadata_json), Text())])
+
+
+def _execute_and_fetch(connection, fetch, query, *args, **kw):
+    # NOTE: This is a blocking operation and runs in the thread pool.
+    result = connection.execute(query, *args, **kw)
+    return getattr(result, fetch)()
+
+
+def _execute_many(connection, statement, params):
+    # NOTE: This is a blocking operation and runs in the thread pool.
+    connection.execute(statement, params)
+
+
+def _run_transaction(connection, func, *args):
+    # NOTE: This is a blocking operation and runs in the thread pool.
+    if isinstance(connection, Engine):
+        return _run_pooled_transaction(connection, func, *args)
+    trx = connection.begin()
+    try:
+        result = func(connection, *args)
+    except Exception:
+        trx.rollback()
+        raise
+    trx.commit()
+    return result
+
+
+def _run_pooled_transaction(sa_engine, func, *args):
+    # NOTE: This is a blocking operation and runs in the thread pool.
+    connection = sa_engine.connect()
+    try:
+        return _run_transaction(connection, func, *args)
+    finally:
+        connection.close()
+
+
+# alchimia has no public way to get from a connection to its engine, or to run
+# our own blocking code in its thread pool. Everything that needs its
+# internals goes through these helpers, so there's only one place to change if
+# they move.
+
+def _get_alchimia_engine(connection):
+    """
+    Return the alchimia engine for an alchimia engine or connection.
+    """
+    if connection is None or isinstance(connection, TwistedEngine):
+        return connection
+    return connection._engine
+
+
+def _get_alchimia_reactor(connection):
+    return _get_alchimia_engine(connection)._reactor
+
+
+def _defer_to_thread(connection, func, *args, **kw):
+    """
+    Call ``func(sa_connection, *args, **kw)`` in alchimia's thread pool.
+
+    ``sa_connection`` is the SQLAlchemy engine or connection underneath the
+    alchimia one we're given, so ``func`` must work with either.
+    """
+    engine = _get_alchimia_engine(connection)
+    if connection is engine:
+        sa_connection = engine._engine
+    else:
+        sa_connection = connection._connection
+    return engine._defer_to_thread(func, sa_connection, *args, **kw)
+
+
 class _PrefixedTables(object):
     def __init__(self, name, connection):
         self.name = name
+        # This may be either a connection or an engine. If it's an engine,
+        # each query uses a connection from the engine's pool.
         self._conn = connection
         self._metadata = MetaData()
-        for attr in dir(self):
-            attrval = getattr(self, attr)
-            if isinstance(attrval, make_table):
-                setattr(self, attr, attrval.make_table(
-                    self.get_table_name(attr), self._metadata))
+        # Our table specs need to be sorted out before any of them are used.
+        self._get_table_specs()
+
+    @classmethod
+    def _get_table_specs(cls):
+        """
+        Return a tuple of ``(attr, make_table)`` pairs for this class.
+
+        The class hierarchy is only scanned once, the result is cached on the
+        class itself.
+
+        A descriptor can't tell which attribute it was accessed through, so if
+        the same :class:`make_table` is used for more than one attribute, each
+        extra attribute is given its own copy of it.
+        """
+        # We check the class dict directly so subclasses don't pick up their
+        # parent's cached specs.
+        specs = cls.__dict__.get('_table_specs')
+        if specs is None:
+            found = {}
+            for klass in reversed(cls.__mro__):
+                for attr, attrval in vars(klass).items():
+                    if isinstance(attrval, make_table):
+                        found[attr] = attrval
+                    else:
+                        found.pop(attr, None)
+            specs = []
+            seen = set()
+            for attr, spec in sorted(found.items()):
+                if spec in seen:
+                    spec = type(spec)(*spec.args, **spec.kw)
+                    setattr(cls, attr, spec)
+                seen.add(spec)
+                specs.append((attr, spec))
+            specs = tuple(specs)
+            cls._table_specs = specs
+        return specs
+
+    def _build_table(self, spec):
+        for attr, attrval in self._get_table_specs():
+            if attrval is spec:
+                break
+        else:
+            raise ValueError("Unknown table spec: %r" % (spec,))
+        table = spec.make_table(self.get_table_name(attr), self._metadata)
+        # This hides the make_table descriptor for this instance.
+        self.__dict__[attr] = table
+        return table
+
+    def _build_all_tables(self):
+        for attr, _ in self._get_table_specs():
+            getattr(self, attr)
+
+    @property
+    def _engine(self):
+        return _get_alchimia_engine(self._conn)
 
     def get_table_name(self, name):
         raise NotImplementedError(
             "_PrefixedTables should not be used directly.")
 
-    def _create_table(self, trx, table):
-        # This works around alchimia's current inability to create tables only
-        # if they don't already exist.
-
-        def table_exists_errback(f):
-            for err_template in TABLE_EXISTS_ERR_TEMPLATES:
-                # Sometimes the table name is lowercased.
-                for name in (table.name, table.name.lower()):
-                    if err_template % {'name': name} in str(f.value):
-                        return None
-            return f
+    def _create_tables_blocking(self, connection):
+        # NOTE: This is a blocking operation and runs in the thread pool, in a
+        # transaction.
+        for table in self._metadata.sorted_tables:
+            # Some databases (PostgreSQL, for example) abort the whole
+            # transaction when a statement fails, so we check for existing
+            # tables rather than ignoring errors from CREATE TABLE.
+            try:
+                table.create(connection, checkfirst=True)
+            except Exception as e:
+                # Someone else may have created the table since we checked.
+                if not _is_table_exists_error(table, e):
+                    raise
+
+    def _run_in_transaction(self, func, *args):
+        """
+        Call ``func(connection, *args)`` in the thread pool, in a transaction.
 
-        d = self._conn.execute(CreateTable(table))
-        d.addErrback(table_exists_errback)
-        return d.addCallback(lambda r: trx)
+        This lets us run several statements in a single trip to the thread
+        pool instead of bouncing through the reactor between them. A
+        connection can only run one statement at a time, so we couldn't issue
+        them in parallel anyway.
+        """
+        return _defer_to_thread(self._conn, _run_transaction, func, *args)
 
     def _create_tables(self):
-        d = self._conn.begin()
-        for table in self._metadata.sorted_tables:
-            d.addCallback(self._create_table, table)
-        return d.addCallback(lambda trx: trx.commit())
+        self._build_all_tables()
+        return self._run_in_transaction(self._create_tables_blocking)
 
     def exists(self):
         raise NotImplementedError(
@@ -105,9 +389,37 @@ class _PrefixedTables(object):
         raise NotImplementedError(
             "_PrefixedTables should not be used directly.")
 
+    def _execute_and_fetch(self, fetch, query, *args, **kw):
+        """
+        Execute a query and return the result of its ``fetch`` method.
+
+        The query and the fetch run in a single trip to the thread pool instead
+        of one trip each. ``fetch`` should be a method that consumes or closes
+        the result, such as ``fetchall``, ``first``, or ``scalar``, so that
+        pooled connections are released.
+        """
+        return _defer_to_thread(
+            self._conn, _execute_and_fetch, fetch, query, *args, **kw)
+
     def execute_fetchall(self, query, *args, **kw):
+        raise NotImplementedError(
+            "_PrefixedTables should not be used directly.")
+
+    def _overrides_execute_query(self, base):
+        """
+        Return ``True`` if our class overrides ``base.execute_query()``.
+        """
+        # Unbound methods aren't identical between lookups on Python 2, so we
+        # compare the functions underneath them.
+        return (type(self).execute_query.__func__ is not
+                base.execute_query.__func__)
+
+    def _execute_fetchall_via_execute_query(self, query, *args, **kw):
+        # A subclass that overrides execute_query() expects to see every
+        # query, so we send this one through it. The fetch then costs a
+        # second trip to the thread pool.
         d = self.execute_query(query, *args, **kw)
-        return d.addCallback(lambda result: result.fetchall())
+        return d.addCallback(_fetchall)
 
 
 class CollectionMetadata(_PrefixedTables):
@@ -115,6 +427,15 @@ class CollectionMetadata(_PrefixedTables):
     Metadata manager for PrefixedTableCollection.
 
     This tracks table prefixes and metadata for a given collection type.
+
+    If ``write_behind_delay`` is set, :meth:`set_metadata` doesn't write to
+    the database immediately. Instead, writes are collected for that many
+    seconds and then written together, so a burst of updates to the same
+    collection only writes the last one. ``clock`` is used to schedule these
+    writes and defaults to the engine's reactor, which must then provide
+    :class:`IReactorTime`. If the engine's reactor provides
+    :class:`IReactorCore`, any pending writes are also flushed before it shuts
+    down.
     """
 
     collection_metadata = make_table(
@@ -122,53 +443,201 @@ class CollectionMetadata(_PrefixedTables):
         Column("metadata_json", Text(), nullable=False),
     )
 
-    _existence_cache_dict = None
+    def __init__(self, name, connection, write_behind_delay=0, clock=None):
+        super(CollectionMetadata, self).__init__(name, connection)
+        self._write_behind_delay = write_behind_delay
+        if write_behind_delay and clock is None:
+            if connection is not None:
+                clock = _get_alchimia_reactor(connection)
+            if not IReactorTime.providedBy(clock):
+                raise ValueError(
+                    "write_behind_delay needs a clock, and the engine's"
+                    " reactor doesn't provide IReactorTime.")
+        self._clock = clock
+        self._pending_writes = {}
+        self._write_waiters = []
+        self._delayed_flush = None
+        self._shutdown_trigger = None
+
+    # Caches are shared between all instances that use the same engine, keyed
+    # by engine and then by collection type.
+    _shared_caches = WeakKeyDictionary()
+
+    _caches_dict = None
 
     @property
-    def _existence_cache(self):
-        if self._existence_cache_dict is None:
-            self._existence_cache_dict = {}
-        return self._existence_cache_dict
+    def _caches(self):
+        if self._caches_dict is None:
+            if self._engine is None:
+                self._caches_dict = {}
+            else:
+                engine_caches = self._shared_caches.setdefault(
+                    self._engine, {})
+                self._caches_dict = engine_caches.setdefault(self.name, {})
+        return self._caches_dict
+
+    @property
+    def _known_present(self):
+        return self._caches.setdefault('present', set())
+
+    _known_absent_set = None
+
+    @property
+    def _known_absent(self):
+        # Unlike the other caches, this belongs to the instance. Another
+        # process can create a collection at any time, so sharing a "not
+        # there" answer would keep it wrong for as long as the engine lives.
+        if self._known_absent_set is None:
+            self._known_absent_set = set()
+        return self._known_absent_set
+
+    @property
+    def _metadata_cache(self):
+        return self._caches.setdefault('metadata', {})
+
+    @property
+    def _pending_lookups(self):
+        return self._caches.setdefault('pending', {})
+
+    @classmethod
+    def clear_cache(cls):
+        """
+        Clear the shared caches for all engines.
+
+        Each instance's record of collections it found to be missing isn't
+        shared, so it isn't cleared. Use :meth:`invalidate` for that.
+        """
+        # Existing instances hold references to their caches, so we need to
+        # empty them rather than just forgetting about them.
+        for engine_caches in cls._shared_caches.values():
+            for caches in engine_caches.values():
+                caches.clear()
+
+    def invalidate(self, name):
+        """
+        Remove any cached information for the named collection.
+
+        :param str name: Name of the collection to invalidate.
+        """
+        self._known_present.discard(name)
+        self._known_absent.discard(name)
+        self._metadata_cache.pop(name, None)
 
     def get_table_name(self, name):
         return '%s_%s' % (name, self.name)
 
     def exists(self):
-        # It would be nice to make this not use private things.
-        return self._conn._engine.has_table(self.collection_metadata.name)
+        # Tables don't disappear in normal operation, so once we've seen the
+        # metadata table we don't ask the database again. If a query later
+        # finds it missing, the cached value is discarded.
+        if self._caches.get('table_exists'):
+            return succeed(True)
+        d = self._engine.has_table(self.collection_metadata.name)
+        return d.addCallback(self._cache_table_exists)
+
+    def _cache_table_exists(self, exists):
+        if exists:
+            self._caches['table_exists'] = True
+        return exists
 
     def create(self):
         return self._create_tables()
 
-    def execute_query(self, query, *args, **kw):
+    def _when_table_exists(self, func, *args, **kw):
+        """
+        Call ``func(*args, **kw)`` if the metadata table exists, and fail with
+        :class:`TableMissingError` if it doesn't.
+
+        We check first, rather than letting the query fail, because on some
+        databases (PostgreSQL, for example) a failed query aborts any
+        transaction the caller has open on the same connection. Once we've
+        seen the table, :meth:`exists` doesn't ask the database again.
+        """
         d = self.exists()
         d.addCallback(
             _false_to_error, TableMissingError(self.collection_metadata.name))
-        d.addCallback(lambda _: self._execute_query(query, *args, **kw))
+        d.addCallback(_call_ignoring_result, func, *args, **kw)
+        d.addErrback(self._table_missing_eb)
         return d
 
-    def _update_existence_cache(self, new_metadata, clear=False):
-        cache = self._existence_cache
+    def execute_query(self, query, *args, **kw):
+        """
+        Execute a query after checking that the metadata table exists.
+
+        If it doesn't, this fails with :class:`TableMissingError`.
+        """
+        return self._when_table_exists(self._execute_query, query, *args, **kw)
+
+    def execute_fetchall(self, query, *args, **kw):
+        """
+        Execute a query and return all the rows from its result.
+
+        As with :meth:`execute_query`, this fails with
+        :class:`TableMissingError` if the metadata table is missing.
+
+        The query and the fetch usually run in a single trip to the thread
+        pool, without going through :meth:`execute_query`. If a subclass
+        overrides :meth:`execute_query`, the query goes through that instead.
+        """
+        if self._overrides_execute_query(CollectionMetadata):
+            return self._execute_fetchall_via_execute_query(
+                query, *args, **kw)
+        return self._when_table_exists(
+            self._execute_and_fetch, 'fetchall', query, *args, **kw)
+
+    def execute_query_checked(self, query, *args, **kw):
+        """
+        Execute a query after checking that the metadata table exists.
+
+        This is the same as :meth:`execute_query`, and is here so both kinds
+        of collection have the same methods.
+        """
+        return self.execute_query(query, *args, **kw)
+
+    def _table_missing_eb(self, failure):
+        if _is_table_missing_error(self.collection_metadata, failure.value):
+            self._caches.pop('table_exists', None)
+            raise TableMissingError(self.collection_metadata.name)
+        return failure
+
+    def _update_caches(self, new_metadata, clear=False):
+        known_present = self._known_present
+        known_absent = self._known_absent
+        metadata_cache = self._metadata_cache
         if clear:
-            cache.clear()
-        cache.update(dict((k, False if v is None else True)
-                          for k, v in new_metadata.iteritems()))
+            known_present.clear()
+            known_absent.clear()
+            metadata_cache.clear()
+        for name, metadata_json in new_metadata.iteritems():
+            if metadata_json is None:
+                # Missing collections only go in this instance's cache, so
+                # they mustn't be left in the shared ones.
+                known_present.discard(name)
+                known_absent.add(name)
+                metadata_cache.pop(name, None)
+            else:
+                known_absent.discard(name)
+                known_present.add(name)
+                metadata_cache[name] = metadata_json
         # We return this so we can chain callbacks.
         return new_metadata
 
     def _rows_to_dict(self, rows):
-        metadata_dict = {}
-        for name, metadata_json in rows:
-            metadata_dict[name] = metadata_json
-        return metadata_dict
+        # Each row is a (name, metadata_json) pair.
+        return dict(rows)
 
-    def _add_row_to_metadata(self, row, name):
-        metadata_json = None
-        if row is not None:
-            metadata_json = row.metadata_json
-        self._update_existence_cache({name: metadata_json})
+    def _row_to_metadata_json(self, row):
+        if row is None:
+            return None
+        return row.metadata_json
+
+    def _add_metadata_to_caches(self, metadata_json, name):
+        self._update_caches({name: metadata_json})
         return metadata_json
 
+    def _add_written_metadata_to_caches(self, result, name, metadata_json):
+        return self._update_caches({name: metadata_json})
+
     def _none_if_table_missing_eb(self, failure):
         failure.trap(TableMissingError)
         return None
@@ -179,59 +648,345 @@ class CollectionMetadata(_PrefixedTables):
         return json.loads(metadata_json)
 
     def _get_metadata(self, name):
-        d = self.execute_query(
-            self.collection_metadata.select().where(
-                self.collection_metadata.c.name == name))
-        d.addCallback(lambda result: result.fetchone())
-        d.addCallback(self._add_row_to_metadata, name)
+        # Delayed writes haven't reached the database yet, so we always serve
+        # those ourselves. Anything else only comes from the cache if someone
+        # asked for it to be filled with prefetch_all().
+        if name in self._pending_writes:
+            d = succeed(self._pending_writes[name])
+        elif self._caches.get('prefetched') and name in self._metadata_cache:
+            d = succeed(self._metadata_cache[name])
+        else:
+            d = self._fetch_metadata(name)
+        d.addCallback(self._add_metadata_to_caches, name)
+        return d
+
+    def _fetch_metadata(self, name):
+        # If there's already a query in flight for this name, we wait for its
+        # result instead of sending another one.
+        pending = self._pending_lookups
+        waiters = pending.get(name)
+        if waiters is not None:
+            d = Deferred()
+            waiters.append(d)
+            return d
+
+        waiters = pending[name] = []
+        d = self._when_table_exists(
+            self._execute_and_fetch, 'first',
+            self._get_compiled_statement('select'), b_name=name)
+        d.addCallback(self._row_to_metadata_json)
+        d.addBoth(self._notify_waiters, name, waiters)
         return d
 
+    def _notify_waiters(self, result, name, waiters):
+        pending = self._pending_lookups
+        if pending.get(name) is waiters:
+            del pending[name]
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+        return result
+
     def get_metadata(self, name):
+        """
+        Get the metadata for the named collection.
+
+        :param str name: Name of the collection.
+
+        This queries the database unless :meth:`prefetch_all` has been called
+        for this collection type and engine. After that, metadata is served
+        from a cache that this process keeps up to date with its own writes,
+        but won't see changes made by other processes until the cache is
+        cleared or :meth:`prefetch_all` is called again.
+        """
         d = self._get_metadata(name)
         d.addErrback(self._none_if_table_missing_eb)
         d.addCallback(self._decode_metadata, name)
         return d
 
     def _decode_all_metadata(self, all_metadata):
-        metadata = {}
-        for name, metadata_json in all_metadata.iteritems():
-            if metadata_json is not None:
-                metadata[name] = json.loads(metadata_json)
-        return metadata
+        loads = json.loads
+        return dict((name, loads(metadata_json))
+                    for name, metadata_json in all_metadata.iteritems()
+                    if metadata_json is not None)
+
+    def _decode_aggregate(self, aggregate_json):
+        # Some databases return NULL when aggregating no rows.
+        if aggregate_json is None:
+            return {}
+        return json.loads(aggregate_json)
+
+    def _add_pending_writes(self, all_metadata):
+        # The database doesn't have our delayed writes yet, and clearing the
+        # caches threw them away, so we put them back.
+        if self._pending_writes:
+            all_metadata.update(self._pending_writes)
+            self._update_caches(self._pending_writes)
+        return all_metadata
 
     def get_all_metadata(self):
-        d = self.execute_fetchall(self.collection_metadata.select())
-        d.addCallback(self._rows_to_dict)
-        d.addCallback(self._update_existence_cache, clear=True)
+        aggregate = self._get_dialect_statement(
+            'aggregate', _make_metadata_aggregate)
+        if aggregate is not None:
+            # The database builds a single JSON object for us, so we only have
+            # one row to fetch and one string to decode.
+            d = self._when_table_exists(
+                self._execute_and_fetch, 'scalar', aggregate)
+            d.addCallback(self._decode_aggregate)
+        else:
+            d = self.execute_fetchall(
+                self._get_compiled_statement('select_all'))
+            d.addCallback(self._rows_to_dict)
+        d.addCallback(self._update_caches, clear=True)
+        d.addCallback(self._add_pending_writes)
         d.addCallback(self._decode_all_metadata)
         return d
 
+    def prefetch_all(self):
+        """
+        Fetch all metadata from the database and populate the caches.
+
+        This issues a single query for all collections, after which lookups
+        for any existing collection are served from the cache. It is intended
+        to be called once at startup, before many collections are used.
+
+        The cache is shared by all instances for this collection type and
+        engine. Changes made by other processes aren't seen until it is
+        cleared with :meth:`clear_cache` or this is called again.
+        """
+        d = self.get_all_metadata()
+        return d.addCallback(self._prefetched)
+
+    def _prefetched(self, _):
+        self._caches['prefetched'] = True
+
+    _statements = None
+
+    def _get_statement(self, statement_name):
+        """
+        Return one of our commonly used statements.
+
+        These are built once per instance and take bind parameters instead of
+        values, so we don't rebuild the expression for every query. Because
+        ``name`` is a column, the name in WHERE clauses is bound as
+        ``b_name``.
+        """
+        if self._statements is None:
+            table = self.collection_metadata
+            where_name = table.c.name == bindparam('b_name')
+            self._statements = {
+                'select': table.select().where(where_name),
+                # _rows_to_dict() relies on the column order here.
+                'select_all': select([table.c.name, table.c.metadata_json]),
+                'insert': table.insert(),
+                'update': table.update().where(where_name),
+            }
+        return self._statements[statement_name]
+
+    # Compiled statements only include the columns they're given values for,
+    # so we need to know these up front.
+    _STATEMENT_COLUMN_KEYS = {
+        'insert': ['name', 'metadata_json'],
+        'update': ['metadata_json'],
+    }
+
+    _compiled_statements = None
+
+    def _get_compiled_statement(self, statement_name):
+        """
+        Return one of our commonly used statements, compiled for the database
+        we're talking to.
+
+        Compiling is a large part of the cost of a small query, so we only
+        do it once per statement instead of every time it's executed.
+        """
+        if self._compiled_statements is None:
+            self._compiled_statements = {}
+        if statement_name in self._compiled_statements:
+            return self._compiled_statements[statement_name]
+        dialect = self._engine.dialect
+        compiled = self._get_statement(statement_name).compile(
+            dialect=dialect,
+            column_keys=self._STATEMENT_COLUMN_KEYS.get(statement_name))
+        # As with dialect statements, we can only cache this once the dialect
+        # knows which server version it's talking to.
+        if dialect.server_version_info is not None:
+            self._compiled_statements[statement_name] = compiled
+        return compiled
+
+    _dialect_statements = None
+
+    def _get_dialect_statement(self, statement_name, make_statement):
+        """
+        Return a statement that depends on the database we're talking to.
+
+        The statement is built by calling ``make_statement`` with our metadata
+        table and the engine's dialect, and may be ``None`` if the database
+        doesn't support what we want.
+        """
+        if self._dialect_statements is None:
+            self._dialect_statements = {}
+        if statement_name in self._dialect_statements:
+            return self._dialect_statements[statement_name]
+        dialect = self._engine.dialect
+        statement = make_statement(self.collection_metadata, dialect)
+        # We can only cache this once the dialect knows which server version
+        # it's talking to.
+        if dialect.server_version_info is not None:
+            self._dialect_statements[statement_name] = statement
+        return statement
+
     def set_metadata(self, name, metadata):
+        """
+        Set the metadata for the named collection.
+
+        :param str name: Name of the collection to update.
+        :param dict metadata: Metadata value to store.
+
+        Where the database supports it, this is a single "insert or update"
+        statement, so it also creates the metadata entry if it doesn't exist.
+        """
         metadata_json = json.dumps(metadata)
-        d = self.execute_query(
-            self.collection_metadata.update().where(
-                self.collection_metadata.c.name == name,
-            ).values(metadata_json=metadata_json))
-        d.addCallback(lambda result: {name: metadata_json})
-        d.addCallback(self._update_existence_cache)
+        if self._write_behind_delay:
+            return self._set_metadata_later(name, metadata_json)
+        upsert = self._get_dialect_statement('upsert', _make_metadata_upsert)
+        if upsert is not None:
+            d = self.execute_query(
+                upsert, name=name, metadata_json=metadata_json)
+        else:
+            d = self.execute_query(
+                self._get_compiled_statement('update'),
+                b_name=name, metadata_json=metadata_json)
+        d.addCallback(
+            self._add_written_metadata_to_caches, name, metadata_json)
         return d
 
+    def _set_metadata_later(self, name, metadata_json):
+        # Readers see the new metadata immediately, even though it hasn't been
+        # written yet.
+        self._update_caches({name: metadata_json})
+        self._pending_writes[name] = metadata_json
+        if self._delayed_flush is None:
+            self._delayed_flush = self._clock.callLater(
+                self._write_behind_delay, self._flush_later)
+        if self._shutdown_trigger is None:
+            reactor = _get_alchimia_reactor(self._conn)
+            if IReactorCore.providedBy(reactor):
+                self._shutdown_trigger = reactor.addSystemEventTrigger(
+                    'before', 'shutdown', self._flush_on_shutdown)
+        # Like an immediate write, this fires with the metadata it wrote.
+        d = Deferred()
+        self._write_waiters.append((d, {name: metadata_json}))
+        return d
+
+    def _flush_later(self):
+        self._delayed_flush = None
+        d = self.flush()
+        # Any failure has already been passed to the set_metadata() callers.
+        d.addErrback(lambda _: None)
+
+    def _flush_on_shutdown(self):
+        # The trigger is already being fired, so we mustn't remove it.
+        self._shutdown_trigger = None
+        return self.flush()
+
+    def flush(self):
+        """
+        Write any metadata updates delayed by ``write_behind_delay``.
+
+        :returns:
+            A :class:`Deferred` that fires when the updates have been written.
+        """
+        if self._delayed_flush is not None:
+            self._delayed_flush.cancel()
+            self._delayed_flush = None
+        if self._shutdown_trigger is not None:
+            _get_alchimia_reactor(self._conn).removeSystemEventTrigger(
+                self._shutdown_trigger)
+            self._shutdown_trigger = None
+        writes, self._pending_writes = self._pending_writes, {}
+        waiters, self._write_waiters = self._write_waiters, []
+        if not writes:
+            return succeed(None)
+
+        upsert = self._get_dialect_statement('upsert', _make_metadata_upsert)
+        if upsert is not None:
+            statement, name_key = upsert, 'name'
+        else:
+            statement = self._get_compiled_statement('update')
+            name_key = 'b_name'
+        params = [{name_key: name, 'metadata_json': metadata_json}
+                  for name, metadata_json in sorted(writes.iteritems())]
+        # All the updates are written in a single executemany().
+        d = self._when_table_exists(
+            self._run_in_transaction, _execute_many, statement, params)
+        d.addBoth(self._writes_flushed, writes, waiters)
+        return d
+
+    def _writes_flushed(self, result, writes, waiters):
+        if isinstance(result, Failure):
+            # We don't know what's in the database now.
+            for name in writes:
+                self.invalidate(name)
+        else:
+            # Something may have read the old metadata into the cache while
+            # we were waiting, so we put ours back unless there's an even
+            # newer write pending.
+            self._update_caches(dict(
+                (name, metadata_json)
+                for name, metadata_json in writes.iteritems()
+                if name not in self._pending_writes))
+            result = None
+        for waiter, written in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(written)
+        return result
+
     def _create_collection(self, exists, name, metadata):
-        metadata_json = json.dumps(metadata)
         if exists:
             return
+        metadata_json = json.dumps(metadata)
         if exists is None:
             d = self.create()
         else:
             d = succeed(None)
 
-        d.addCallback(lambda _: self.execute_query(
-            self.collection_metadata.insert().values(
-                name=name, metadata_json=metadata_json)))
-        d.addCallback(lambda result: {name: metadata_json})
-        d.addCallback(self._update_existence_cache)
+        d.addCallback(
+            _call_ignoring_result, self.execute_query,
+            self._get_compiled_statement('insert'),
+            name=name, metadata_json=metadata_json)
+        d.addCallback(
+            self._add_written_metadata_to_caches, name, metadata_json)
         return d
 
+    def _create_collection_blocking(self, connection, name, metadata_json,
+                                   check_table):
+        # NOTE: This is a blocking operation and runs in the thread pool, in a
+        # transaction. It returns the stored metadata, which is what was
+        # already there if the collection exists, and whether we created it.
+        if check_table:
+            self._create_tables_blocking(connection)
+        row = connection.execute(
+            self._get_compiled_statement('select'), b_name=name).first()
+        if row is not None:
+            return row.metadata_json, False
+        connection.execute(
+            self._get_compiled_statement('insert'),
+            name=name, metadata_json=metadata_json)
+        return metadata_json, True
+
+    def _collection_created(self, result, name):
+        metadata_json, created = result
+        self._cache_table_exists(True)
+        self._add_metadata_to_caches(metadata_json, name)
+        if created:
+            # This is what create_collection() returns for a new collection.
+            return {name: metadata_json}
+
     def create_collection(self, name, metadata=None):
         """
         Create a metadata entry for the named collection.
@@ -260,14 +1015,21 @@ class CollectionMetadata(_PrefixedTables):
         table does not exist, ``None`` is returned. Both ``False`` and ``None``
         are truthless values and the difference may be important to the caller.
 
+        Collections that are known to exist are cached for all instances on
+        the same engine, because they aren't removed in normal operation. A
+        missing collection is only remembered by this instance, so a new
+        instance will see it once another process has created it.
+
         :returns:
             A :class:`Deferred` that fires with ``True``, ``False``, or
             ``None``.
         """
-        d = succeed(name)
-        if name not in self._existence_cache:
-            d.addCallback(self._get_metadata)
-        d.addCallback(lambda _: self._existence_cache[name])
+        if name in self._known_present:
+            return succeed(True)
+        if name in self._known_absent:
+            return succeed(False)
+        d = self._get_metadata(name)
+        d.addCallback(_is_not_none)
         d.addErrback(self._none_if_table_missing_eb)
         return d
 
@@ -280,17 +1042,38 @@ class TableCollection(_PrefixedTables):
 
     The collection type defaults to the class name, but the
     :attr:`COLLECTION_TYPE` class attribute may be set to override this.
+
+    ``connection`` may be either an alchimia connection or an alchimia engine.
+    If it is an engine, each query uses a connection from the engine's pool so
+    concurrent queries don't have to wait for each other.
     """
 
     COLLECTION_TYPE = None
 
+    # Collections of the same type on the same connection share a
+    # CollectionMetadata, so its tables and statements are only built once.
+    # Entries are dropped when no collection uses them anymore.
+    _shared_collection_metadata = WeakValueDictionary()
+
     def __init__(self, name, connection, collection_metadata=None):
+        # This is used to name our tables, so it needs to be set before any of
+        # them are built.
+        self._table_name_prefix = '%s_%s_' % (self.collection_type(), name)
         super(TableCollection, self).__init__(name, connection)
         if collection_metadata is None:
-            collection_metadata = CollectionMetadata(
-                self.collection_type(), connection)
+            collection_metadata = self._get_collection_metadata(connection)
         self._collection_metadata = collection_metadata
 
+    @classmethod
+    def _get_collection_metadata(cls, connection):
+        key = (cls.collection_type(), connection)
+        collection_metadata = cls._shared_collection_metadata.get(key)
+        if collection_metadata is None:
+            collection_metadata = CollectionMetadata(
+                cls.collection_type(), connection)
+            cls._shared_collection_metadata[key] = collection_metadata
+        return collection_metadata
+
     @classmethod
     def collection_type(cls):
         ctype = cls.COLLECTION_TYPE
@@ -299,16 +1082,67 @@ class TableCollection(_PrefixedTables):
         return ctype
 
     def get_table_name(self, name):
-        return '%s_%s_%s' % (self.collection_type(), self.name, name)
+        return self._table_name_prefix + name
 
     def exists(self):
         return self._collection_metadata.collection_exists(self.name)
 
+    def _create_tables_and_collection_blocking(self, connection,
+                                               metadata_json, check_table):
+        # NOTE: This is a blocking operation and runs in the thread pool, in a
+        # transaction.
+        self._create_tables_blocking(connection)
+        return self._collection_metadata._create_collection_blocking(
+            connection, self.name, metadata_json, check_table)
+
     def create_tables(self, metadata=None):
-        d = self._create_tables()
-        d.addCallback(lambda _: self._collection_metadata.create_collection(
-            self.name, metadata))
-        return d
+        """
+        Create our tables and a metadata entry for this collection.
+
+        :param dict metadata:
+            Metadata value to store if the collection doesn't already exist.
+            If ``None``, an empty dict will be used.
+
+        :returns:
+            A :class:`Deferred` that fires with ``{name: metadata_json}`` if
+            the collection was created, or ``None`` if it already existed.
+        """
+        cmd = self._collection_metadata
+        if cmd._conn is not self._conn:
+            # We can only share a transaction with the metadata table if we
+            # share a connection (or engine) with it.
+            d = self._create_tables()
+            d.addCallback(
+                _call_ignoring_result, cmd.create_collection, self.name,
+                metadata)
+            return d
+
+        # Our tables and the metadata entry are all created in a single trip
+        # to the thread pool, so we build the tables and statements here
+        # rather than in a worker thread.
+        if metadata is None:
+            metadata = {}
+        self._build_all_tables()
+        cmd._get_compiled_statement('select')
+        cmd._get_compiled_statement('insert')
+        metadata_json = json.dumps(metadata)
+        check_table = not cmd._caches.get('table_exists')
+        d = self._create_tables_and_collection(metadata_json, check_table)
+        if not check_table:
+            # If the metadata table has been dropped since we last saw it, we
+            # forget that it existed and try again, creating it this time.
+            d.addErrback(cmd._table_missing_eb)
+            d.addErrback(self._metadata_table_missing_eb, metadata_json)
+        return d.addCallback(cmd._collection_created, self.name)
+
+    def _create_tables_and_collection(self, metadata_json, check_table):
+        return self._run_in_transaction(
+            self._create_tables_and_collection_blocking, metadata_json,
+            check_table)
+
+    def _metadata_table_missing_eb(self, failure, metadata_json):
+        failure.trap(TableMissingError)
+        return self._create_tables_and_collection(metadata_json, True)
 
     def get_metadata(self):
         return self._collection_metadata.get_metadata(self.name)
@@ -317,7 +1151,48 @@ class TableCollection(_PrefixedTables):
         return self._collection_metadata.set_metadata(self.name, metadata)
 
     def execute_query(self, query, *args, **kw):
+        """
+        Execute a query.
+
+        We don't check that the collection exists first, because that would
+        cost an extra round trip if it isn't cached. Instead, if the query
+        fails because one of our tables is missing, this fails with
+        :class:`CollectionMissingError`. Queries that don't touch any of our
+        tables aren't checked at all, use :meth:`execute_query_checked` if
+        that matters.
+        """
+        d = self._execute_query(query, *args, **kw)
+        return d.addErrback(self._table_missing_eb)
+
+    def execute_fetchall(self, query, *args, **kw):
+        """
+        Execute a query and return all the rows from its result.
+
+        As with :meth:`execute_query`, this fails with
+        :class:`CollectionMissingError` if one of our tables is missing.
+
+        The query and the fetch usually run in a single trip to the thread
+        pool, without going through :meth:`execute_query`. If a subclass
+        overrides :meth:`execute_query`, the query goes through that instead.
+        """
+        if self._overrides_execute_query(TableCollection):
+            return self._execute_fetchall_via_execute_query(
+                query, *args, **kw)
+        d = self._execute_and_fetch('fetchall', query, *args, **kw)
+        return d.addErrback(self._table_missing_eb)
+
+    def execute_query_checked(self, query, *args, **kw):
+        """
+        Execute a query after checking that the collection exists.
+        """
         d = self.exists()
         d.addCallback(_false_to_error, CollectionMissingError(self.name))
-        d.addCallback(lambda _: self._execute_query(query, *args, **kw))
+        d.addCallback(
+            _call_ignoring_result, self._execute_query, query, *args, **kw)
         return d
+
+    def _table_missing_eb(self, failure):
+        for table in self._metadata.tables.values():
+            if _is_table_missing_error(table, failure.value):
+                raise CollectionMissingError(self.name)
+        return failure
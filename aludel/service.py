@@ -7,21 +7,27 @@ TODO: Document this better.
 """
 
 from functools import wraps, update_wrapper
-import json
+from json import dumps as _json_dumps, loads as _json_loads
 
 from klein import Klein
 
-from twisted.internet.defer import maybeDeferred
+from twisted.internet.defer import Deferred, fail, succeed
 from twisted.python import log
+from twisted.python.failure import Failure
 
 
 __all__ = [
     'APIError', 'BadRequestParams', 'handler', 'service',
-    'set_request_id', 'get_request_id', 'get_params', 'get_json_params',
-    'get_url_params', 'format_response', 'format_error',
+    'set_request_id', 'get_request_id', 'make_param_validator', 'get_params',
+    'get_json_params', 'get_url_params', 'format_response', 'format_error',
 ]
 
 
+_CONTENT_TYPE = b'Content-Type'
+_JSON_CONTENT_TYPE = b'application/json'
+_ERROR_PREFIX_NO_REQUEST_ID = b'{"request_id":null,"error":'
+
+
 class APIError(Exception):
     code = 500
     message = None  # Replace BaseException's deprecated message attr.
@@ -60,17 +66,40 @@ def service(service_class):
     :func:`handler`-decorated methods on it so it can be used as a Klein HTTP
     resource.
 
+    Decorating the same class more than once has no further effect.
+
     TODO: Document this better.
     """
+    if vars(service_class).get('_aludel_wired', False):
+        # We only check this class, because a subclass of a service still
+        # needs its own app.
+        return service_class
     service_class.app = Klein()
-    for attr in dir(service_class):
-        meth = getattr(service_class, attr)
-        if hasattr(meth, '_handler_args'):
-            handler = _make_handler(service_class, meth)
-            setattr(service_class, attr, handler)
+    for attr, meth in _find_handlers(service_class):
+        handler = _make_handler(service_class, meth)
+        setattr(service_class, attr, handler)
+    service_class._aludel_wired = True
     return service_class
 
 
+def _find_handlers(service_class):
+    """
+    Return a sorted list of ``(attr, func)`` pairs for the handler methods on
+    ``service_class`` and its bases.
+
+    We look in the class dicts directly rather than using ``dir()`` and
+    ``getattr()``, which would check every inherited attribute.
+    """
+    handlers = {}
+    for klass in reversed(service_class.__mro__):
+        for attr, value in vars(klass).items():
+            if hasattr(value, '_handler_args'):
+                handlers[attr] = value
+            else:
+                handlers.pop(attr, None)
+    return sorted(handlers.items())
+
+
 def _make_handler(service_class, handler_method):
     args, kw = handler_method._handler_args
 
@@ -83,10 +112,25 @@ def _make_handler(service_class, handler_method):
 
 
 def _handler_wrapper(func, self, request, *args, **kw):
-    d = maybeDeferred(func, self, request, *args, **kw)
-    d.addCallback(format_response, request)
-    if hasattr(self, 'handle_api_error'):
-        d.addErrback(self.handle_api_error, request)
+    # This does the same job as maybeDeferred(), but most handlers return a
+    # plain dict and we can format that immediately instead of building a
+    # callback chain for it.
+    try:
+        result = func(self, request, *args, **kw)
+        if not isinstance(result, (Deferred, Failure)):
+            return succeed(format_response(result, request))
+    except Exception:
+        d = fail()
+    else:
+        if isinstance(result, Failure):
+            d = fail(result)
+        else:
+            d = result.addCallback(format_response, request)
+    # The custom error handler may come from a subclass or the instance, so
+    # we look for it here rather than when the handler is wired up.
+    custom_errback = getattr(self, 'handle_api_error', None)
+    if custom_errback is not None:
+        d.addErrback(custom_errback, request)
     d.addErrback(_handle_api_error, request)
     return d
 
@@ -100,51 +144,123 @@ def _handle_api_error(failure, request):
 
 
 def set_request_id(request, request_id):
-    # We name-mangle the attr because `request` isn't our object.
-    request.__request_id = request_id
+    # We prefix the attr because `request` isn't our object. (Module-level
+    # code doesn't get name-mangled, so a leading `__` doesn't help here.)
+    request._aludel_request_id = request_id
 
 
 def get_request_id(request):
-    try:
-        return request.__request_id
-    except AttributeError:
-        return None
+    return getattr(request, '_aludel_request_id', None)
+
+
+def make_param_validator(mandatory, optional=()):
+    """Build a validator for request parameters.
+
+    The returned function takes a params dict and either returns it unchanged
+    or raises :class:`BadRequestParams`. It can be passed to the ``get_*``
+    helpers in place of ``mandatory`` so the parameter sets are only built
+    once, rather than on every request.
+    """
+    mandatory = frozenset(mandatory)
+    allowed = mandatory | frozenset(optional)
+    # Missing params are always a subset of the mandatory ones, so we can
+    # safely cache their error messages. Unexpected params come from the
+    # client and could be anything, so we don't cache those.
+    missing_messages = {}
+
+    def validate_params(params):
+        # Most requests have valid params, so we check for that first. This
+        # isn't free (each check copies the keys into a temporary set), but
+        # it skips building the missing and extra sets below.
+        if mandatory.issubset(params) and allowed.issuperset(params):
+            return params
+        keys = set(params)
+        missing = mandatory - keys
+        extra = keys - allowed
+        if missing:
+            message = missing_messages.get(missing)
+            if message is None:
+                message = "Missing request parameters: '%s'" % (
+                    "', '".join(sorted(missing)))
+                missing_messages[missing] = message
+            raise BadRequestParams(message)
+        if extra:
+            raise BadRequestParams("Unexpected request parameters: '%s'" % (
+                "', '".join(sorted(extra))))
+        return params
+    return validate_params
+
+
+# Validators for callers that pass plain parameter lists, keyed by those lists
+# as tuples. Handlers pass the same literal lists on every request, so this
+# only grows with the number of distinct handlers.
+_param_validators = {}
 
 
 def get_params(params, mandatory, optional=()):
-    keys = set(params.keys())
-    missing = set(mandatory) - keys
-    extra = keys - (set(mandatory) | set(optional))
-    if missing:
-        raise BadRequestParams("Missing request parameters: '%s'" % (
-            "', '".join(sorted(missing))))
-    if extra:
-        raise BadRequestParams("Unexpected request parameters: '%s'" % (
-            "', '".join(sorted(extra))))
-    return params
+    if callable(mandatory):
+        # This is already a validator built by make_param_validator().
+        return mandatory(params)
+    key = (tuple(mandatory), tuple(optional))
+    try:
+        validator = _param_validators[key]
+    except KeyError:
+        validator = make_param_validator(mandatory, optional)
+        _param_validators[key] = validator
+    return validator(params)
+
 
+def get_json_params(request, mandatory, optional=(), max_body_size=None):
+    """Decode and validate a JSON request body.
 
-def get_json_params(request, mandatory, optional=()):
-    return get_params(json.loads(request.content.read()), mandatory, optional)
+    If ``max_body_size`` is given, bodies longer than that many bytes are
+    rejected with a 413 error without being decoded.
+    """
+    if max_body_size is None:
+        body = request.content.read()
+    else:
+        # We read one byte more than the limit so we can tell if there's any
+        # more without reading the whole thing.
+        body = request.content.read(max_body_size + 1)
+        if len(body) > max_body_size:
+            raise APIError('Request body too large.', 413)
+    return get_params(_json_loads(body), mandatory, optional)
 
 
 def get_url_params(request, mandatory, optional=()):
-    if 'request_id' in request.args:
-        set_request_id(request, request.args['request_id'][0])
-    params = get_params(request.args, mandatory, optional)
+    args = request.args
+    if 'request_id' in args:
+        set_request_id(request, args['request_id'][0])
+    params = get_params(args, mandatory, optional)
     return dict((k, v[0]) for k, v in params.iteritems())
 
 
 def format_response(params, request):
-    request.setHeader('Content-Type', 'application/json')
+    """Encode a handler's response dict as JSON.
+
+    The response always has a ``request_id`` field, which is ``null`` if no
+    request id was set. Clients may rely on this, so we include it even when
+    it's empty.
+    """
+    request.setHeader(_CONTENT_TYPE, _JSON_CONTENT_TYPE)
     params['request_id'] = get_request_id(request)
-    return json.dumps(params)
+    return _json_dumps(params)
 
 
 def format_error(error, request):
-    request.setHeader('Content-Type', 'application/json')
+    """Encode an :class:`APIError` as a JSON error response.
+
+    As with :func:`format_response`, the ``request_id`` field is always
+    present.
+    """
+    request.setHeader(_CONTENT_TYPE, _JSON_CONTENT_TYPE)
     request.setResponseCode(error.code)
-    return json.dumps({
-        'request_id': get_request_id(request),
+    request_id = get_request_id(request)
+    if request_id is None:
+        # This is the usual case for errors, so we only need to encode the
+        # message.
+        return _ERROR_PREFIX_NO_REQUEST_ID + _json_dumps(error.message) + b'}'
+    return _json_dumps({
+        'request_id': request_id,
         'error': error.message,
     })
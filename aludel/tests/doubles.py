@@ -1,4 +1,4 @@
-from twisted.internet.interfaces import IReactorThreads
+from twisted.internet.interfaces import IReactorCore, IReactorThreads
 from twisted.python.failure import Failure
 from zope.interface import implementer
 
@@ -8,23 +8,60 @@ class FakeThreadPool(object):
         return func(*args, **kw)
 
     def callInThreadWithCallback(self, onResult, func, *args, **kw):
-        if onResult is None:
-            onResult = lambda success, result: result
         try:
             result = func(*args, **kw)
         except Exception as e:
-            onResult(False, Failure(e))
+            if onResult is not None:
+                onResult(False, Failure(e))
         else:
-            onResult(True, result)
+            if onResult is not None:
+                onResult(True, result)
 
 
 @implementer(IReactorThreads)
 class FakeReactorThreads(object):
+    _threadpool = None
+
     def getThreadPool(self):
-        return FakeThreadPool()
+        # The pool has no state, so we only need one. alchimia asks for it on
+        # every query.
+        if self._threadpool is None:
+            self._threadpool = FakeThreadPool()
+        return self._threadpool
 
     def callInThread(self, callable, *args, **kwargs):
         return callable(*args, **kwargs)
 
     def callFromThread(self, callable, *args, **kw):
         return callable(*args, **kw)
+
+
+@implementer(IReactorCore)
+class FakeReactorShutdown(FakeReactorThreads):
+    """
+    A FakeReactorThreads that also keeps track of system event triggers.
+    """
+
+    def __init__(self):
+        self.triggers = {}
+        self._next_trigger_id = 0
+
+    def addSystemEventTrigger(self, phase, eventType, callable, *args, **kw):
+        self._next_trigger_id += 1
+        self.triggers[self._next_trigger_id] = (
+            phase, eventType, callable, args, kw)
+        return self._next_trigger_id
+
+    def removeSystemEventTrigger(self, triggerID):
+        del self.triggers[triggerID]
+
+    def fire_shutdown(self):
+        """
+        Call the "before shutdown" triggers and return their results.
+        """
+        results = []
+        for trigger_id, trigger in sorted(self.triggers.items()):
+            phase, eventType, callable, args, kw = trigger
+            if (phase, eventType) == ('before', 'shutdown'):
+                results.append(callable(*args, **kw))
+        return results
@@ -4,24 +4,44 @@ import os
 from sqlalchemy import (
     Table, Column, Integer, String, UniqueConstraint, MetaData
 )
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.schema import DropTable
 from sqlalchemy.types import UserDefinedType
-from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SkipTest, TestCase
 
+from aludel import database
 from aludel.database import (
     get_engine, make_table, CollectionMissingError, _PrefixedTables,
-    CollectionMetadata, TableCollection,
+    CollectionMetadata, TableCollection, TableMissingError,
+    _is_table_exists_error, _is_table_missing_error, _make_metadata_upsert,
+    _make_metadata_aggregate,
 )
 
-from .doubles import FakeReactorThreads
+from .doubles import FakeReactorShutdown, FakeReactorThreads
 
 
 class DatabaseTestCase(TestCase):
+    # Building an engine is fairly expensive, so we share one between all our
+    # tests. Each test drops its tables when it's done. We do this in setUp()
+    # rather than setUpClass() because trial and Python 2.6 don't support the
+    # latter.
+    _shared_engine = None
+
     def setUp(self):
-        connection_string = os.environ.get(
-            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
-        self.engine = get_engine(
-            connection_string, reactor=FakeReactorThreads())
-        self._drop_tables()
+        self.engine = DatabaseTestCase._shared_engine
+        if self.engine is None:
+            connection_string = os.environ.get(
+                "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+            self.engine = get_engine(
+                connection_string, reactor=FakeReactorThreads())
+            DatabaseTestCase._shared_engine = self.engine
+            # Clean up anything left over from previous test runs.
+            self._drop_tables()
+        # The metadata caches are shared by engine, so we need to make sure
+        # nothing is left over from previous tests.
+        CollectionMetadata.clear_cache()
         self.conn = self.successResultOf(self.engine.connect())
 
     def tearDown(self):
@@ -31,9 +51,132 @@ class DatabaseTestCase(TestCase):
 
     def _drop_tables(self):
         # NOTE: This is a blocking operation!
-        md = MetaData(bind=self.engine._engine)
-        md.reflect()
-        md.drop_all()
+        # We only need the table names to drop them, so we avoid reflecting
+        # all their columns and constraints. None of our test tables have
+        # foreign keys, so the order doesn't matter.
+        sa_engine = self.engine._engine
+        with sa_engine.begin() as conn:
+            for name in sa_engine.table_names(connection=conn):
+                conn.execute(DropTable(Table(name, MetaData())))
+
+
+class Test_is_table_exists_error(TestCase):
+    def assert_exists_error(self, message, table_name="MyTable"):
+        table = Table(table_name, MetaData())
+        assert _is_table_exists_error(table, Exception(message)) is True
+
+    def assert_not_exists_error(self, message, table_name="MyTable"):
+        table = Table(table_name, MetaData())
+        assert _is_table_exists_error(table, Exception(message)) is False
+
+    def test_sqlite(self):
+        """
+        SQLite "table exists" errors should be recognised.
+        """
+        self.assert_exists_error('table MyTable already exists')
+        self.assert_exists_error('(OperationalError) table "MyTable" already '
+                                 'exists')
+
+    def test_postgresql(self):
+        """
+        PostgreSQL "relation exists" errors should be recognised, even if the
+        table name is lowercased.
+        """
+        self.assert_exists_error('relation "mytable" already exists')
+        self.assert_exists_error('relation MyTable already exists')
+
+    def test_mysql(self):
+        """
+        MySQL "table exists" errors should be recognised.
+        """
+        self.assert_exists_error("Table 'MyTable' already exists")
+
+    def test_other_errors(self):
+        """
+        Other errors, or errors for other tables, should not be recognised.
+        """
+        self.assert_not_exists_error('syntax error')
+        self.assert_not_exists_error('table OtherTable already exists')
+        self.assert_not_exists_error('table MyxTable already exists',
+                                     table_name="My.Table")
+        self.assert_not_exists_error('table MyTable2 already exists')
+
+
+class Test_is_table_missing_error(TestCase):
+    def assert_missing_error(self, message, table_name="MyTable"):
+        table = Table(table_name, MetaData())
+        assert _is_table_missing_error(table, Exception(message)) is True
+
+    def assert_not_missing_error(self, message, table_name="MyTable"):
+        table = Table(table_name, MetaData())
+        assert _is_table_missing_error(table, Exception(message)) is False
+
+    def test_sqlite(self):
+        """
+        SQLite "no such table" errors should be recognised.
+        """
+        self.assert_missing_error('(OperationalError) no such table: MyTable')
+
+    def test_postgresql(self):
+        """
+        PostgreSQL "relation does not exist" errors should be recognised, even
+        if the table name is lowercased.
+        """
+        self.assert_missing_error('relation "mytable" does not exist')
+
+    def test_mysql(self):
+        """
+        MySQL "table doesn't exist" errors should be recognised, with or
+        without the database name.
+        """
+        self.assert_missing_error("Table 'MyTable' doesn't exist")
+        self.assert_missing_error("Table 'aludel_test.MyTable' doesn't exist")
+
+    def test_other_errors(self):
+        """
+        Other errors, or errors for other tables, should not be recognised.
+        """
+        self.assert_not_missing_error('syntax error')
+        self.assert_not_missing_error('no such table: OtherTable')
+        self.assert_not_missing_error('no such table: MyTable2')
+
+
+class Test_make_metadata_aggregate(TestCase):
+    def get_table(self):
+        return CollectionMetadata('MyTables', None).collection_metadata
+
+    def get_dialect(self, module, server_version_info):
+        dialect = module.dialect()
+        dialect.server_version_info = server_version_info
+        return dialect
+
+    def compile_aggregate(self, dialect):
+        aggregate = _make_metadata_aggregate(self.get_table(), dialect)
+        if aggregate is None:
+            return None
+        return str(aggregate.compile(dialect=dialect))
+
+    def test_sqlite(self):
+        sql = self.compile_aggregate(self.get_dialect(sqlite, (3, 38, 0)))
+        assert 'CAST(json_group_object(' in sql
+        assert ') AS TEXT)' in sql
+        assert self.compile_aggregate(
+            self.get_dialect(sqlite, (3, 37, 2))) is None
+
+    def test_postgresql(self):
+        """
+        The aggregate is cast to text, so psycopg2 gives us a string instead
+        of decoding the json value itself.
+        """
+        sql = self.compile_aggregate(self.get_dialect(postgresql, (9, 4)))
+        assert 'CAST(json_object_agg(' in sql
+        assert ') AS TEXT)' in sql
+        assert self.compile_aggregate(
+            self.get_dialect(postgresql, (9, 3))) is None
+
+    def test_mysql(self):
+        assert self.compile_aggregate(
+            self.get_dialect(mysql, (5, 7, 22))) is None
 
 
 class Test_PrefixedTables(DatabaseTestCase):
@@ -121,6 +264,39 @@ class TestCollectionMetadata(DatabaseTestCase):
         assert self.successResultOf(has_table_d) is True
         assert self.successResultOf(cmd.exists()) is True
 
+    def test_exists_cached(self):
+        """
+        .exists() should not check the database again once the table is known
+        to exist.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        assert self.successResultOf(cmd.exists()) is False
+        assert 'table_exists' not in cmd._caches
+        self.successResultOf(cmd.create())
+        assert self.successResultOf(cmd.exists()) is True
+        assert cmd._caches['table_exists'] is True
+
+        # Drop the table behind the cache's back.
+        self.successResultOf(
+            self.conn.execute(DropTable(cmd.collection_metadata)))
+        assert self.successResultOf(cmd.exists()) is True
+
+    def test_execute_query_table_dropped(self):
+        """
+        .execute_query() should fail with TableMissingError and clear the
+        cached table existence if the table has been dropped.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        assert self.successResultOf(cmd.exists()) is True
+
+        # Drop the table behind the cache's back.
+        self.successResultOf(
+            self.conn.execute(DropTable(cmd.collection_metadata)))
+        self.failureResultOf(cmd.get_all_metadata(), TableMissingError)
+        assert 'table_exists' not in cmd._caches
+        assert self.successResultOf(cmd.exists()) is False
+
     def test_collection_exists_no_table(self):
         """
         .collection_exists() should return None if the metadata table does not
@@ -155,9 +331,129 @@ class TestCollectionMetadata(DatabaseTestCase):
         """
         cmd = CollectionMetadata('MyTables', self.conn)
         self.successResultOf(cmd.create())
-        cmd._existence_cache['foo'] = True
+        cmd._known_present.add('foo')
         assert self.successResultOf(cmd.collection_exists('foo')) is True
 
+    def test_collection_exists_after_create_collection(self):
+        """
+        .collection_exists() should not query the database for a collection
+        we've just created.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo', {'bar': 'baz'}))
+        # Remove the row behind the cache's back, so we can tell if the
+        # database is queried.
+        self.successResultOf(self.conn.execute(
+            cmd.collection_metadata.delete()))
+        assert self.successResultOf(cmd.collection_exists('foo')) is True
+
+    def test_collection_exists_cache_shared(self):
+        """
+        .collection_exists() should share cached results between instances for
+        the same collection type and engine.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        cmd._known_present.add('foo')
+        cmd2 = CollectionMetadata('MyTables', self.conn)
+        assert self.successResultOf(cmd2.collection_exists('foo')) is True
+        cmd3 = CollectionMetadata('YourTables', self.conn)
+        assert 'foo' not in cmd3._known_present
+
+    def test_collection_exists_missing_not_shared(self):
+        """
+        .collection_exists() should not share a "missing" result between
+        instances, because another process may create the collection.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        assert self.successResultOf(cmd.collection_exists('foo')) is False
+        # Create the collection behind the cache's back, as another process
+        # would.
+        self.successResultOf(self.conn.execute(
+            cmd.collection_metadata.insert().values(
+                name='foo', metadata_json='{}')))
+        cmd2 = CollectionMetadata('MyTables', self.conn)
+        assert 'foo' not in cmd2._known_absent
+        assert self.successResultOf(cmd2.collection_exists('foo')) is True
+
+    def test_invalidate(self):
+        """
+        .invalidate() should remove the cached result for the provided name.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        cmd._known_present.add('foo')
+        cmd.invalidate('foo')
+        assert 'foo' not in cmd._known_present
+        assert self.successResultOf(cmd.collection_exists('foo')) is False
+
+    def test_clear_cache(self):
+        """
+        .clear_cache() should remove all cached results.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        cmd._known_present.add('foo')
+        CollectionMetadata.clear_cache()
+        assert 'foo' not in cmd._known_present
+        cmd2 = CollectionMetadata('MyTables', self.conn)
+        assert 'foo' not in cmd2._known_present
+
+    def test_execute_query_no_table(self):
+        """
+        .execute_query() should fail with TableMissingError if the metadata
+        table does not exist.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.failureResultOf(
+            cmd.execute_query(cmd.collection_metadata.select()),
+            TableMissingError)
+
+    def test_execute_query_no_table_not_run(self):
+        """
+        .execute_query() should not run the query if the metadata table does
+        not exist, because a failed query can abort the caller's transaction.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        queries = []
+        cmd._execute_query = lambda query, *args, **kw: queries.append(query)
+        self.failureResultOf(
+            cmd.execute_query(cmd.collection_metadata.select()),
+            TableMissingError)
+        assert queries == []
+
+    def test_execute_query_checked_no_table(self):
+        """
+        .execute_query_checked() should fail with TableMissingError if the
+        metadata table does not exist, without running the query.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.failureResultOf(
+            cmd.execute_query_checked("SELECT 42;"), TableMissingError)
+
+    def test_execute_fetchall(self):
+        """
+        .execute_fetchall() should query the database and return all rows from
+        the result.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo', {'bar': 'baz'}))
+        rows = self.successResultOf(cmd.execute_fetchall(
+            cmd.collection_metadata.select()))
+        assert [row.name for row in rows] == ['foo']
+
+    def test_execute_fetchall_no_table(self):
+        """
+        .execute_fetchall() should fail with TableMissingError if the metadata
+        table does not exist.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.failureResultOf(
+            cmd.execute_fetchall(cmd.collection_metadata.select()),
+            TableMissingError)
+
     def test_get_metadata_no_table(self):
         """
         .get_metadata() should fail with CollectionMissingError if the metadata
@@ -192,9 +488,11 @@ class TestCollectionMetadata(DatabaseTestCase):
         self.successResultOf(cmd.create())
         self.successResultOf(cmd.create_collection('foo', {'bar': 'baz'}))
         # Set this back to False because create_collection updated it.
-        cmd._existence_cache['foo'] = False
+        cmd._known_present.discard('foo')
+        cmd._known_absent.add('foo')
         assert self.successResultOf(cmd.get_metadata('foo')) == {'bar': 'baz'}
-        assert cmd._existence_cache['foo'] is True
+        assert 'foo' in cmd._known_present
+        assert 'foo' not in cmd._known_absent
 
     def test_get_metadata_updates_existence_cache_missing_collection(self):
         """
@@ -202,9 +500,9 @@ class TestCollectionMetadata(DatabaseTestCase):
         """
         cmd = CollectionMetadata('MyTables', self.conn)
         self.successResultOf(cmd.create())
-        assert 'foo' not in cmd._existence_cache
+        assert 'foo' not in cmd._known_absent
         self.failureResultOf(cmd.get_metadata('foo'), CollectionMissingError)
-        assert cmd._existence_cache['foo'] is False
+        assert 'foo' in cmd._known_absent
 
     def test_get_all_metadata(self):
         """
@@ -217,6 +515,132 @@ class TestCollectionMetadata(DatabaseTestCase):
         metadata = self.successResultOf(cmd.get_all_metadata())
         assert metadata == {'foo': {'a': 1}, 'bar': {'b': 2}}
 
+    def test_get_metadata_cached(self):
+        """
+        After .prefetch_all(), .get_metadata() should return cached metadata
+        for the provided name without querying the database.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.prefetch_all())
+        cmd._metadata_cache['foo'] = json.dumps({'bar': 'baz'})
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'bar': 'baz'}
+        assert 'foo' in cmd._known_present
+
+    def test_get_metadata_not_cached_without_prefetch(self):
+        """
+        Without .prefetch_all(), .get_metadata() should query the database so
+        it sees changes made by other processes.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo', {'v': 1}))
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'v': 1}
+        # Update the row behind the cache's back, as another process would.
+        table = cmd.collection_metadata
+        self.successResultOf(self.conn.execute(
+            table.update().where(table.c.name == 'foo').values(
+                metadata_json=json.dumps({'v': 2}))))
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'v': 2}
+        cmd2 = CollectionMetadata('MyTables', self.conn)
+        assert self.successResultOf(cmd2.get_metadata('foo')) == {'v': 2}
+
+    def test_get_metadata_concurrent(self):
+        """
+        Concurrent .get_metadata() calls for the same name should share a
+        single query.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo', {'bar': 'baz'}))
+        CollectionMetadata.clear_cache()
+
+        queries = []
+        execute_and_fetch = cmd._execute_and_fetch
+
+        def delayed_execute_and_fetch(fetch, query, *args, **kw):
+            d = Deferred()
+            queries.append(d)
+            d.addCallback(
+                lambda _: execute_and_fetch(fetch, query, *args, **kw))
+            return d
+
+        cmd._execute_and_fetch = delayed_execute_and_fetch
+        d1 = cmd.get_metadata('foo')
+        d2 = cmd.get_metadata('foo')
+        assert len(queries) == 1
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+
+        queries[0].callback(None)
+        assert self.successResultOf(d1) == {'bar': 'baz'}
+        assert self.successResultOf(d2) == {'bar': 'baz'}
+        assert cmd._pending_lookups == {}
+
+    def test_get_metadata_concurrent_failure(self):
+        """
+        A failed query should fail all concurrent .get_metadata() calls for
+        the same name.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        queries = []
+
+        def delayed_execute_and_fetch(fetch, query, *args, **kw):
+            d = Deferred()
+            queries.append(d)
+            return d
+
+        cmd._execute_and_fetch = delayed_execute_and_fetch
+        d1 = cmd.get_metadata('foo')
+        d2 = cmd.get_metadata('foo')
+        assert len(queries) == 1
+        queries[0].errback(TableMissingError('foo'))
+        self.failureResultOf(d1, CollectionMissingError)
+        self.failureResultOf(d2, CollectionMissingError)
+        assert cmd._pending_lookups == {}
+
+    def test_prefetch_all(self):
+        """
+        .prefetch_all() should populate the caches with all metadata from the
+        database.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo', {'a': 1}))
+        self.successResultOf(cmd.create_collection('bar', {'b': 2}))
+        CollectionMetadata.clear_cache()
+
+        cmd = CollectionMetadata('MyTables', self.conn)
+        assert self.successResultOf(cmd.prefetch_all()) is None
+        assert cmd._known_present == set(['foo', 'bar'])
+        assert cmd._known_absent == set()
+        assert sorted(cmd._metadata_cache.keys()) == ['bar', 'foo']
+        assert json.loads(cmd._metadata_cache['foo']) == {'a': 1}
+        assert json.loads(cmd._metadata_cache['bar']) == {'b': 2}
+
+    def test_get_all_metadata_no_aggregate(self):
+        """
+        .get_all_metadata() should fetch all metadata from the database even
+        if there is no JSON aggregate support.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        cmd._dialect_statements = {'aggregate': None}
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo', {'a': 1}))
+        self.successResultOf(cmd.create_collection('bar', {'b': 2}))
+        metadata = self.successResultOf(cmd.get_all_metadata())
+        assert metadata == {'foo': {'a': 1}, 'bar': {'b': 2}}
+
+    def test_get_all_metadata_empty(self):
+        """
+        .get_all_metadata() should return an empty dict if there is no
+        metadata.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        assert self.successResultOf(cmd.get_all_metadata()) == {}
+
     def test__decode_all_metadata_with_none(self):
         """
         ._decode_all_metadata() should ignore empty metadata entries.
@@ -236,6 +660,224 @@ class TestCollectionMetadata(DatabaseTestCase):
         self.successResultOf(cmd.set_metadata('foo', {'bar': 'baz'}))
         assert self.successResultOf(cmd.get_metadata('foo')) == {'bar': 'baz'}
 
+    def test_compiled_statements_cached(self):
+        """
+        Compiled statements should only be built once.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        compiled = cmd._get_compiled_statement('insert')
+        assert cmd._get_compiled_statement('insert') is compiled
+        assert sorted(compiled.params) == ['metadata_json', 'name']
+
+    def test_set_metadata_no_upsert(self):
+        """
+        .set_metadata() should update the database even if there is no upsert
+        support.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        cmd._dialect_statements = {'upsert': None}
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo'))
+        self.successResultOf(cmd.create_collection('bar'))
+        self.successResultOf(cmd.set_metadata('foo', {'bar': 'baz'}))
+        CollectionMetadata.clear_cache()
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'bar': 'baz'}
+        assert self.successResultOf(cmd.get_metadata('bar')) == {}
+
+    def test_set_metadata_missing_collection(self):
+        """
+        .set_metadata() should create the collection's metadata entry if it
+        doesn't exist and the database supports "insert or update".
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        if cmd._get_dialect_statement('upsert', _make_metadata_upsert) is None:
+            raise SkipTest("No upsert support for this database.")
+        self.successResultOf(cmd.set_metadata('foo', {'bar': 'baz'}))
+        CollectionMetadata.clear_cache()
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'bar': 'baz'}
+
+    def test_set_metadata_write_behind(self):
+        """
+        .set_metadata() should delay writes if write_behind_delay is set, and
+        only write the latest metadata for each collection.
+        """
+        clock = Clock()
+        cmd = CollectionMetadata(
+            'MyTables', self.conn, write_behind_delay=1, clock=clock)
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo'))
+        self.successResultOf(cmd.create_collection('bar'))
+
+        d1 = cmd.set_metadata('foo', {'a': 1})
+        d2 = cmd.set_metadata('foo', {'a': 2})
+        d3 = cmd.set_metadata('bar', {'b': 3})
+        # The new metadata is visible before it's written.
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'a': 2}
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+        self.assertNoResult(d3)
+        CollectionMetadata.clear_cache()
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'a': 2}
+        # Nothing has been written yet.
+        cmd2 = CollectionMetadata('MyTables', self.conn)
+        assert self.successResultOf(cmd2.get_metadata('foo')) == {}
+
+        clock.advance(1)
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+        self.successResultOf(d3)
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'a': 2}
+        assert self.successResultOf(cmd2.get_metadata('foo')) == {'a': 2}
+        CollectionMetadata.clear_cache()
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'a': 2}
+        assert self.successResultOf(cmd.get_metadata('bar')) == {'b': 3}
+
+    def test_set_metadata_write_behind_result(self):
+        """
+        A delayed .set_metadata() should fire with the same result as an
+        immediate one.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo'))
+        expected = self.successResultOf(cmd.set_metadata('foo', {'a': 1}))
+        assert expected == {'foo': json.dumps({'a': 1})}
+
+        clock = Clock()
+        cmd = CollectionMetadata(
+            'MyTables', self.conn, write_behind_delay=1, clock=clock)
+        d = cmd.set_metadata('foo', {'a': 1})
+        clock.advance(1)
+        assert self.successResultOf(d) == expected
+
+    def test_get_all_metadata_write_behind(self):
+        """
+        .get_all_metadata() and .prefetch_all() should not lose delayed writes
+        that haven't been flushed yet.
+        """
+        clock = Clock()
+        cmd = CollectionMetadata(
+            'MyTables', self.conn, write_behind_delay=1, clock=clock)
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo', {'a': 1}))
+        self.successResultOf(cmd.create_collection('bar', {'b': 1}))
+        cmd.set_metadata('foo', {'a': 2})
+
+        metadata = self.successResultOf(cmd.get_all_metadata())
+        assert metadata == {'foo': {'a': 2}, 'bar': {'b': 1}}
+        self.successResultOf(cmd.prefetch_all())
+        assert json.loads(cmd._metadata_cache['foo']) == {'a': 2}
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'a': 2}
+
+    def test_set_metadata_write_behind_no_upsert(self):
+        """
+        Delayed writes should update the database even if there is no upsert
+        support.
+        """
+        clock = Clock()
+        cmd = CollectionMetadata(
+            'MyTables', self.conn, write_behind_delay=1, clock=clock)
+        cmd._dialect_statements = {'upsert': None}
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo'))
+        d = cmd.set_metadata('foo', {'a': 1})
+        clock.advance(1)
+        self.successResultOf(d)
+        CollectionMetadata.clear_cache()
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'a': 1}
+
+    def test_write_behind_needs_clock(self):
+        """
+        If write_behind_delay is set without a clock, the engine's reactor
+        must be able to schedule calls.
+        """
+        self.assertRaises(
+            ValueError, CollectionMetadata, 'MyTables', self.conn,
+            write_behind_delay=1)
+        self.assertRaises(
+            ValueError, CollectionMetadata, 'MyTables', None,
+            write_behind_delay=1)
+
+    def test_write_behind_flushed_on_shutdown(self):
+        """
+        Delayed writes should be flushed before the reactor shuts down.
+        """
+        reactor = FakeReactorShutdown()
+        self.patch(
+            database, '_get_alchimia_reactor', lambda connection: reactor)
+        clock = Clock()
+        cmd = CollectionMetadata(
+            'MyTables', self.conn, write_behind_delay=1, clock=clock)
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo'))
+        assert reactor.triggers == {}
+
+        d = cmd.set_metadata('foo', {'a': 1})
+        cmd.set_metadata('foo', {'a': 2})
+        assert len(reactor.triggers) == 1
+        [result] = reactor.fire_shutdown()
+        self.successResultOf(result)
+        self.successResultOf(d)
+        assert clock.getDelayedCalls() == []
+        CollectionMetadata.clear_cache()
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'a': 2}
+
+    def test_flush_removes_shutdown_trigger(self):
+        """
+        .flush() should remove the shutdown trigger, because there's nothing
+        left to write.
+        """
+        reactor = FakeReactorShutdown()
+        self.patch(
+            database, '_get_alchimia_reactor', lambda connection: reactor)
+        cmd = CollectionMetadata(
+            'MyTables', self.conn, write_behind_delay=1, clock=Clock())
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo'))
+        d = cmd.set_metadata('foo', {'a': 1})
+        assert len(reactor.triggers) == 1
+        self.successResultOf(cmd.flush())
+        self.successResultOf(d)
+        assert reactor.triggers == {}
+
+    def test_flush(self):
+        """
+        .flush() should write delayed metadata immediately.
+        """
+        clock = Clock()
+        cmd = CollectionMetadata(
+            'MyTables', self.conn, write_behind_delay=1, clock=clock)
+        self.successResultOf(cmd.create())
+        self.successResultOf(cmd.create_collection('foo'))
+        d = cmd.set_metadata('foo', {'a': 1})
+        self.successResultOf(cmd.flush())
+        self.successResultOf(d)
+        assert clock.getDelayedCalls() == []
+        CollectionMetadata.clear_cache()
+        assert self.successResultOf(cmd.get_metadata('foo')) == {'a': 1}
+
+    def test_flush_nothing_pending(self):
+        """
+        .flush() should do nothing if there are no delayed writes.
+        """
+        cmd = CollectionMetadata('MyTables', self.conn)
+        assert self.successResultOf(cmd.flush()) is None
+
+    def test_flush_no_table(self):
+        """
+        If delayed writes fail, the callers should see the failure and the
+        cached metadata should be discarded.
+        """
+        clock = Clock()
+        cmd = CollectionMetadata(
+            'MyTables', self.conn, write_behind_delay=1, clock=clock)
+        d = cmd.set_metadata('foo', {'a': 1})
+        clock.advance(1)
+        self.failureResultOf(d, TableMissingError)
+        assert 'foo' not in cmd._metadata_cache
+        assert 'foo' not in cmd._known_present
+
     def test_create_collection_no_table(self):
         """
         .create_collection() should call .create() before creating the
@@ -243,7 +885,7 @@ class TestCollectionMetadata(DatabaseTestCase):
         """
         cmd = CollectionMetadata('MyTables', self.conn)
         self.successResultOf(cmd.create_collection('foo'))
-        assert cmd._existence_cache['foo'] is True
+        assert 'foo' in cmd._known_present
         assert self.successResultOf(cmd.get_metadata('foo')) == {}
 
     def test_create_collection_no_metadata(self):
@@ -254,7 +896,7 @@ class TestCollectionMetadata(DatabaseTestCase):
         cmd = CollectionMetadata('MyTables', self.conn)
         self.successResultOf(cmd.create())
         self.successResultOf(cmd.create_collection('foo'))
-        assert cmd._existence_cache['foo'] is True
+        assert 'foo' in cmd._known_present
         assert self.successResultOf(cmd.get_metadata('foo')) == {}
 
     def test_create_collection_with_metadata(self):
@@ -265,7 +907,7 @@ class TestCollectionMetadata(DatabaseTestCase):
         cmd = CollectionMetadata('MyTables', self.conn)
         self.successResultOf(cmd.create())
         self.successResultOf(cmd.create_collection('foo', {'bar': 'baz'}))
-        assert cmd._existence_cache['foo'] is True
+        assert 'foo' in cmd._known_present
         assert self.successResultOf(cmd.get_metadata('foo')) == {'bar': 'baz'}
 
 
@@ -316,6 +958,22 @@ class TestTableCollection(DatabaseTestCase):
         my_tables = TableCollection("foo", None)
         assert isinstance(my_tables._collection_metadata, CollectionMetadata)
 
+    def test_init_shares_collection_metadata(self):
+        """
+        TableCollections of the same type on the same connection should share
+        the collection_metadata they build.
+        """
+        class MyTables(TableCollection):
+            pass
+
+        class YourTables(TableCollection):
+            pass
+
+        cmd = MyTables("foo", self.conn)._collection_metadata
+        assert MyTables("bar", self.conn)._collection_metadata is cmd
+        assert YourTables("foo", self.conn)._collection_metadata is not cmd
+        assert MyTables("foo", self.engine)._collection_metadata is not cmd
+
     def test_get_table_name(self):
         """
         .get_table_name() should build an appropriate table name from the
@@ -352,6 +1010,69 @@ class TestTableCollection(DatabaseTestCase):
         assert my_tables_2.tbl.name == 'MyTables_prefix2_tbl'
         assert len(my_tables_2.tbl.c) == 3
 
+    def test_make_table_aliased(self):
+        """
+        A make_table() used for more than one attribute should build a
+        separate table for each of them.
+        """
+        class MyTables(TableCollection):
+            tbl1 = tbl2 = make_table(
+                Column("id", Integer(), primary_key=True),
+            )
+
+        my_tables = MyTables("prefix", self.conn)
+        assert my_tables.tbl2.name == 'MyTables_prefix_tbl2'
+        assert my_tables.tbl1.name == 'MyTables_prefix_tbl1'
+
+        self.successResultOf(my_tables.create_tables())
+        self.successResultOf(self.conn.execute(my_tables.tbl1.select()))
+        self.successResultOf(self.conn.execute(my_tables.tbl2.select()))
+
+    def test_make_table_lazy(self):
+        """
+        Tables built by make_table() should only be built when they're first
+        accessed.
+        """
+        class MyTables(TableCollection):
+            tbl1 = make_table(
+                Column("id", Integer(), primary_key=True),
+            )
+            tbl2 = make_table(
+                Column("id", Integer(), primary_key=True),
+            )
+
+        assert isinstance(MyTables.tbl1, make_table)
+        my_tables = MyTables("prefix", self.conn)
+        assert 'tbl1' not in my_tables.__dict__
+        assert list(my_tables._metadata.tables) == []
+
+        tbl1 = my_tables.tbl1
+        assert my_tables.__dict__['tbl1'] is tbl1
+        assert my_tables.tbl1 is tbl1
+        assert list(my_tables._metadata.tables) == ['MyTables_prefix_tbl1']
+
+    def test_make_table_inherited(self):
+        """
+        Tables built by make_table() on a parent class should be built for
+        subclasses as well, and the table specs should be cached per class.
+        """
+        class MyTables(TableCollection):
+            tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+            )
+
+        class MoreTables(MyTables):
+            other_tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+            )
+
+        my_tables = MoreTables("prefix", self.conn)
+        assert my_tables.tbl.name == 'MoreTables_prefix_tbl'
+        assert my_tables.other_tbl.name == 'MoreTables_prefix_other_tbl'
+        assert [attr for attr, _ in MoreTables._table_specs] == [
+            'other_tbl', 'tbl']
+        assert [attr for attr, _ in MyTables._get_table_specs()] == ['tbl']
+
     def test_create_tables_with_metadata(self):
         """
         .create_tables() should create the tables belonging to the collection
@@ -415,6 +1136,46 @@ class TestTableCollection(DatabaseTestCase):
         self.successResultOf(self.conn.execute(my_tables.tbl2.select()))
         assert self.successResultOf(cmd.get_metadata("foo")) == {}
 
+    def test_create_tables_no_metadata_table(self):
+        """
+        .create_tables() should create the metadata table if it doesn't
+        already exist.
+        """
+        class MyTables(TableCollection):
+            tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+                Column("value", String(255)),
+            )
+
+        my_tables = MyTables("foo", self.conn)
+        cmd = my_tables._collection_metadata
+        assert self.successResultOf(cmd.exists()) is False
+
+        self.successResultOf(my_tables.create_tables(metadata={'bar': 'baz'}))
+        assert self.successResultOf(cmd.exists()) is True
+        self.successResultOf(self.conn.execute(my_tables.tbl.select()))
+        assert self.successResultOf(cmd.get_metadata("foo")) == {'bar': 'baz'}
+
+    def test_create_tables_separate_metadata_connection(self):
+        """
+        .create_tables() should still set metadata if the collection metadata
+        doesn't use our connection.
+        """
+        class MyTables(TableCollection):
+            tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+                Column("value", String(255)),
+            )
+
+        cmd = CollectionMetadata(MyTables.collection_type(), self.engine)
+        self.successResultOf(cmd.create())
+        my_tables = MyTables("foo", self.conn, cmd)
+
+        self.successResultOf(my_tables.create_tables(metadata={'bar': 'baz'}))
+        assert self.successResultOf(my_tables.exists()) is True
+        self.successResultOf(self.conn.execute(my_tables.tbl.select()))
+        assert self.successResultOf(cmd.get_metadata("foo")) == {'bar': 'baz'}
+
     def test_create_tables_already_exists(self):
         """
         .create_tables() should do nothing if the tables already exist.
@@ -438,6 +1199,95 @@ class TestTableCollection(DatabaseTestCase):
         assert self.successResultOf(my_tables.exists()) is True
         assert self.successResultOf(cmd.get_metadata("foo")) == {'bar': 'baz'}
 
+    def test_create_tables_already_exists_no_failed_create(self):
+        """
+        .create_tables() should not try to create tables that already exist.
+        PostgreSQL aborts the whole transaction when a statement fails, so we
+        can't just ignore the error.
+        """
+        class MyTables(TableCollection):
+            tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+                Column("value", String(255)),
+            )
+
+        cmd = self._get_cmd(MyTables)
+        my_tables = MyTables("foo", self.conn, cmd)
+        self.successResultOf(my_tables.create_tables(metadata={'bar': 'baz'}))
+
+        checked_errors = []
+
+        def is_table_exists_error(table, err):
+            checked_errors.append(err)
+            return _is_table_exists_error(table, err)
+
+        self.patch(database, '_is_table_exists_error', is_table_exists_error)
+        self.successResultOf(my_tables.create_tables(metadata={'a': 'b'}))
+        assert checked_errors == []
+        assert self.successResultOf(cmd.get_metadata("foo")) == {'bar': 'baz'}
+
+    def test_create_tables_metadata_table_race(self):
+        """
+        .create_tables() should cope with the metadata table being created by
+        someone else between checking for it and creating it.
+        """
+        class MyTables(TableCollection):
+            tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+            )
+
+        my_tables = MyTables("foo", self.conn)
+        cmd = my_tables._collection_metadata
+        self.successResultOf(cmd.create())
+        CollectionMetadata.clear_cache()
+        # We pretend no tables exist yet, so the metadata table we just
+        # created looks like it was created after we checked.
+        self.patch(
+            self.engine.dialect, 'has_table', lambda *args, **kw: False)
+
+        self.successResultOf(my_tables.create_tables(metadata={'a': 'b'}))
+        assert self.successResultOf(cmd.get_metadata("foo")) == {'a': 'b'}
+
+    def test_create_tables_result(self):
+        """
+        .create_tables() should return the new metadata entry if it created
+        the collection, and ``None`` if the collection already existed.
+        """
+        class MyTables(TableCollection):
+            tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+            )
+
+        my_tables = MyTables("foo", self.conn)
+        result = self.successResultOf(
+            my_tables.create_tables(metadata={'bar': 'baz'}))
+        assert result.keys() == ["foo"]
+        assert json.loads(result["foo"]) == {'bar': 'baz'}
+        assert self.successResultOf(my_tables.create_tables()) is None
+
+    def test_create_tables_metadata_table_dropped(self):
+        """
+        .create_tables() should recreate the metadata table if it has been
+        dropped since we last saw it.
+        """
+        class MyTables(TableCollection):
+            tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+            )
+
+        my_tables = MyTables("foo", self.conn)
+        cmd = my_tables._collection_metadata
+        self.successResultOf(my_tables.create_tables())
+        self.successResultOf(
+            self.conn.execute(DropTable(cmd.collection_metadata)))
+
+        other_tables = MyTables("bar", self.conn)
+        self.successResultOf(other_tables.create_tables(metadata={'a': 'b'}))
+        assert self.successResultOf(cmd.get_metadata("bar")) == {'a': 'b'}
+        # Subsequent calls still work.
+        self.successResultOf(my_tables.create_tables())
+        assert self.successResultOf(cmd.get_metadata("foo")) == {}
+
     def test_create_tables_error(self):
         """
         .create_tables() should fail if the tables can't be created.
@@ -502,11 +1352,49 @@ class TestTableCollection(DatabaseTestCase):
     def test_execute_query_no_collection(self):
         """
         .execute_query() should fail with CollectionMissingError if the
-        collection does not exist.
+        collection's tables do not exist.
+        """
+        class MyTables(TableCollection):
+            tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+            )
+
+        my_tables = MyTables("prefix", self.conn)
+        self.failureResultOf(
+            my_tables.execute_query(my_tables.tbl.select()),
+            CollectionMissingError)
+
+    def test_execute_query_unchecked(self):
+        """
+        .execute_query() should not check that the collection exists for
+        queries that don't use the collection's tables.
+        """
+        my_tables = TableCollection("prefix", self.conn)
+        result = self.successResultOf(my_tables.execute_query("SELECT 42;"))
+        rows = self.successResultOf(result.fetchall())
+        assert rows == [(42,)]
+
+    def test_execute_query_checked_happy(self):
+        """
+        .execute_query_checked() should query the database and return a
+        result.
+        """
+        my_tables = TableCollection("prefix", self.conn)
+        self.successResultOf(my_tables.create_tables())
+        result = self.successResultOf(
+            my_tables.execute_query_checked("SELECT 42;"))
+        rows = self.successResultOf(result.fetchall())
+        assert rows == [(42,)]
+
+    def test_execute_query_checked_no_collection(self):
+        """
+        .execute_query_checked() should fail with CollectionMissingError if
+        the collection does not exist.
         """
         my_tables = TableCollection("prefix", self.conn)
         self.failureResultOf(
-            my_tables.execute_query("SELECT 42;"), CollectionMissingError)
+            my_tables.execute_query_checked("SELECT 42;"),
+            CollectionMissingError)
 
     def test_execute_query_error(self):
         """
@@ -516,14 +1404,66 @@ class TestTableCollection(DatabaseTestCase):
         self.successResultOf(my_tables.create_tables())
         self.failureResultOf(my_tables.execute_query("SELECT ;;"))
 
+    def test_execute_fetchall_overridden_execute_query(self):
+        """
+        .execute_fetchall() should use execute_query() if a subclass overrides
+        it.
+        """
+        queries = []
+
+        class MyTables(TableCollection):
+            tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+            )
+
+            def execute_query(slf, query, *args, **kw):
+                queries.append(query)
+                return super(MyTables, slf).execute_query(query, *args, **kw)
+
+        my_tables = MyTables("prefix", self.conn)
+        self.successResultOf(my_tables.create_tables())
+        self.successResultOf(
+            self.conn.execute(my_tables.tbl.insert().values(id=1)))
+        query = my_tables.tbl.select()
+        rows = self.successResultOf(my_tables.execute_fetchall(query))
+        assert [tuple(row) for row in rows] == [(1,)]
+        assert queries == [query]
+
     def test_execute_fetchall_no_collection(self):
         """
         .execute_fetchall() should fail with CollectionMissingError if the
-        collection does not exist.
+        collection's tables do not exist.
         """
-        my_tables = TableCollection("prefix", self.conn)
+        class MyTables(TableCollection):
+            tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+            )
+
+        my_tables = MyTables("prefix", self.conn)
         self.failureResultOf(
-            my_tables.execute_fetchall("SELECT 42;"), CollectionMissingError)
+            my_tables.execute_fetchall(my_tables.tbl.select()),
+            CollectionMissingError)
+
+    def test_engine_instead_of_connection(self):
+        """
+        TableCollection should use pooled connections if given an engine.
+        """
+        class MyTables(TableCollection):
+            tbl = make_table(
+                Column("id", Integer(), primary_key=True),
+                Column("value", String(255)),
+            )
+
+        my_tables = MyTables("prefix", self.engine)
+        assert my_tables._engine is self.engine
+        self.successResultOf(my_tables.create_tables(metadata={'bar': 'baz'}))
+        self.successResultOf(my_tables.execute_query(
+            my_tables.tbl.insert().values(id=1, value='foo')))
+        rows = self.successResultOf(my_tables.execute_fetchall(
+            my_tables.tbl.select()))
+        assert rows == [(1, 'foo')]
+        CollectionMetadata.clear_cache()
+        assert self.successResultOf(my_tables.get_metadata()) == {'bar': 'baz'}
 
     def test_execute_fetchall(self):
         """
@@ -52,6 +52,7 @@ class TestFakeReactorThreads(TestCase):
     def test_getThreadPool(self):
         reactor = FakeReactorThreads()
         assert isinstance(reactor.getThreadPool(), FakeThreadPool)
+        assert reactor.getThreadPool() is reactor.getThreadPool()
 
     def test_callInThread(self):
         reactor = FakeReactorThreads()
@@ -1,57 +1,123 @@
 import json
 from urllib import urlencode
-from StringIO import StringIO
 
 from klein import Klein
+from zope.interface import implementer
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import fail, inlineCallbacks, succeed
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import deferLater
 from twisted.trial.unittest import TestCase
-from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
 from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
 from twisted.web.server import Site
 
 from aludel import service
 
 
+class FakeContent(object):
+    """
+    Minimal read-only stand-in for a request's content file.
+
+    Most tests never read the content, so this just keeps the string instead
+    of setting up a StringIO.
+    """
+
+    def __init__(self, data):
+        self._data = data
+
+    def read(self, size=-1):
+        if size < 0:
+            data, self._data = self._data, ''
+        else:
+            data, self._data = self._data[:size], self._data[size:]
+        return data
+
+
 class FakeRequest(object):
     def __init__(self, content=None, args=None):
         self.code = 200
-        self.headers = {}
-        self.content = StringIO(content or '')
+        # Headers are stored as they're set and only collected into a dict
+        # if a test looks at them.
+        self._header_names = []
+        self._header_values = []
+        self.content = FakeContent(content or '')
         self.args = args or {}
 
     def setResponseCode(self, code):
         self.code = code
 
+    @property
+    def headers(self):
+        headers = {}
+        for name, value in zip(self._header_names, self._header_values):
+            headers.setdefault(name, []).append(value)
+        return headers
+
     def setHeader(self, name, value):
-        values = self.headers.setdefault(name.lower(), [])
-        values.append(value)
+        self._header_names.append(name.lower())
+        self._header_values.append(value)
+
+
+@implementer(IBodyProducer)
+class BytesProducer(object):
+    """
+    Request body producer that writes the whole body at once.
+
+    Our request bodies are small, so we don't need FileBodyProducer's
+    chunking.
+    """
+
+    def __init__(self, body):
+        self._body = body
+        self.length = len(body)
+
+    def startProducing(self, consumer):
+        consumer.write(self._body)
+        return succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
 
 
 class ApiClient(object):
-    def __init__(self, base_url):
-        self._base_url = base_url
+    def __init__(self, base_url, agent=None):
+        self._url_prefix = base_url.rstrip('/') + '/'
+        if agent is None:
+            agent = Agent(reactor)
+        self._agent = agent
 
     def _make_url(self, url_path):
-        return '%s/%s' % (self._base_url, url_path.lstrip('/'))
+        return self._url_prefix + url_path.lstrip('/')
 
     def _make_call(self, method, url_path, headers, body, expected_code):
-        agent = Agent(reactor)
         url = self._make_url(url_path)
-        d = agent.request(method, url, headers, body)
+        d = self._agent.request(method, url, headers, body)
         return d.addCallback(self._get_response_body, expected_code)
 
     def _get_response_body(self, response, expected_code):
-        assert response.code == expected_code
+        if response.code != expected_code:
+            # We don't care what's in the body, so throw it away unread.
+            response.deliverBody(Protocol())
+            raise AssertionError("Expected response code %s, got %s." % (
+                expected_code, response.code))
         return readBody(response).addCallback(json.loads)
 
     def get(self, url_path, params, expected_code=200):
-        url_path = '?'.join([url_path, urlencode(params)])
+        if params:
+            url_path = url_path + '?' + urlencode(params)
         return self._make_call('GET', url_path, None, None, expected_code)
 
     def put(self, url_path, headers, content, expected_code=200):
-        body = FileBodyProducer(StringIO(content))
+        body = BytesProducer(content)
         return self._make_call('PUT', url_path, headers, body, expected_code)
 
 
@@ -59,6 +125,7 @@ class TestService(TestCase):
     timeout = 5
 
     listener = None
+    pool = None
 
     def tearDown(self):
         return self.stop_listening()
@@ -68,12 +135,19 @@ class TestService(TestCase):
         site = Site(service_instance.app.resource())
         self.listener = reactor.listenTCP(0, site, interface='localhost')
         self.listener_port = self.listener.getHost().port
-        return ApiClient('http://localhost:%s' % self.listener_port)
+        # Requests from the same test share a persistent connection.
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        agent = Agent(reactor, pool=self.pool)
+        return ApiClient('http://localhost:%s' % self.listener_port, agent)
 
+    @inlineCallbacks
     def stop_listening(self):
+        if self.pool is not None:
+            self.pool, pool = None, self.pool
+            yield pool.closeCachedConnections()
         if self.listener is not None:
             self.listener, listener = None, self.listener
-            return listener.loseConnection()
+            yield listener.loseConnection()
 
     def test_make_service(self):
         @service.service
@@ -91,6 +165,54 @@ class TestService(TestCase):
             'hello': 'world',
         }
 
+    def test_make_service_twice(self):
+        @service.service
+        class FooService(object):
+            @service.handler('/hello/<string:who>')
+            def hello(slf, request, who):
+                return {'hello': who}
+
+        app = FooService.app
+        hello = vars(FooService)['hello']
+        assert service.service(FooService) is FooService
+        assert FooService.app is app
+        assert vars(FooService)['hello'] is hello
+
+        req = FakeRequest()
+        resp = self.successResultOf(FooService().hello(req, 'world'))
+        assert json.loads(resp) == {
+            'request_id': None,
+            'hello': 'world',
+        }
+
+    def test_make_service_inherited_handlers(self):
+        class BaseService(object):
+            @service.handler('/hello/<string:who>')
+            def hello(slf, request, who):
+                return {'hello': who}
+
+            @service.handler('/bye/<string:who>')
+            def bye(slf, request, who):
+                return {'bye': who}
+
+        @service.service
+        class FooService(BaseService):
+            bye = None
+
+            @service.handler('/hi/<string:who>')
+            def hi(slf, request, who):
+                return {'hi': who}
+
+        endpoints = sorted(
+            rule.endpoint for rule in FooService.app.url_map.iter_rules())
+        assert endpoints == ['hello', 'hi']
+        req = FakeRequest()
+        resp = self.successResultOf(FooService().hello(req, 'world'))
+        assert json.loads(resp) == {
+            'request_id': None,
+            'hello': 'world',
+        }
+
     def test_request_id(self):
         req = FakeRequest()
         assert service.get_request_id(req) is None
@@ -141,6 +263,66 @@ class TestService(TestCase):
             'bar': 'world',
         }
 
+    def test_get_params_validator(self):
+        validator = service.make_param_validator(['foo'], ['bar', 'baz'])
+        params = {
+            'foo': 'hello',
+            'bar': 'world',
+        }
+        assert service.get_params(params, validator) == {
+            'foo': 'hello',
+            'bar': 'world',
+        }
+        err = self.assertRaises(service.BadRequestParams, service.get_params,
+                                {'bar': 'world'}, validator)
+        assert err.message == (
+            "Missing request parameters: 'foo'")
+        err = self.assertRaises(service.BadRequestParams, service.get_params,
+                                {'foo': 'hello', 'quux': 'x'}, validator)
+        assert err.message == (
+            "Unexpected request parameters: 'quux'")
+
+    def test_get_params_reuses_validator(self):
+        params = {'foo': 'hello'}
+        assert service.get_params(params, ['foo'], ['bar']) == params
+        validator = service._param_validators[(('foo',), ('bar',))]
+        assert service.get_params(params, ['foo'], ['bar']) == params
+        assert service._param_validators[(('foo',), ('bar',))] is validator
+
+    def test_get_params_validator_repeated_errors(self):
+        validator = service.make_param_validator(['foo', 'bar'])
+        for _ in range(2):
+            err = self.assertRaises(
+                service.BadRequestParams, validator, {'baz': 'x'})
+            assert err.message == (
+                "Missing request parameters: 'bar', 'foo'")
+            err = self.assertRaises(
+                service.BadRequestParams, validator, {'bar': 'x'})
+            assert err.message == (
+                "Missing request parameters: 'foo'")
+
+    def test_get_params_repeated_errors(self):
+        """
+        Callers that pass plain lists should also reuse the cached error
+        messages.
+        """
+        messages = []
+        for _ in range(2):
+            err = self.assertRaises(
+                service.BadRequestParams, service.get_params, {'baz': 'x'},
+                ['foo', 'bar'])
+            messages.append(err.message)
+        assert messages[0] == "Missing request parameters: 'bar', 'foo'"
+        assert messages[0] is messages[1]
+
+    def test_get_url_params_validator(self):
+        validator = service.make_param_validator(['foo'], ['bar', 'baz'])
+        req = FakeRequest(args={'foo': ['hello', 'bye'], 'bar': ['world']})
+        assert service.get_url_params(req, validator) == {
+            'foo': 'hello',
+            'bar': 'world',
+        }
+
     def test_get_json_params(self):
         req = FakeRequest(content=json.dumps({'foo': 'hello', 'bar': 'world'}))
         assert service.get_json_params(req, ['foo'], ['bar', 'baz']) == {
@@ -148,6 +330,29 @@ class TestService(TestCase):
             'bar': 'world',
         }
 
+    def test_get_json_params_validator(self):
+        validator = service.make_param_validator(['foo'], ['bar', 'baz'])
+        req = FakeRequest(content=json.dumps({'foo': 'hello', 'bar': 'world'}))
+        assert service.get_json_params(req, validator) == {
+            'foo': 'hello',
+            'bar': 'world',
+        }
+
+    def test_get_json_params_max_body_size(self):
+        body = json.dumps({'foo': 'hello', 'bar': 'world'})
+        req = FakeRequest(content=body)
+        assert service.get_json_params(
+            req, ['foo'], ['bar'], max_body_size=len(body)) == {
+            'foo': 'hello',
+            'bar': 'world',
+        }
+        req = FakeRequest(content=body)
+        err = self.assertRaises(
+            service.APIError, service.get_json_params, req, ['foo'], ['bar'],
+            max_body_size=len(body) - 1)
+        assert err.code == 413
+        assert err.message == 'Request body too large.'
+
     def test_get_url_params_no_request_id(self):
         req = FakeRequest(args={'foo': ['hello', 'bye'], 'bar': ['world']})
         assert service.get_url_params(req, ['foo'], ['bar', 'baz']) == {
@@ -198,6 +403,15 @@ class TestService(TestCase):
             'error': 'bad thing',
         }
 
+    def test_format_error_escaped_message(self):
+        req = FakeRequest()
+        message = u'bad "thing" \u2603\n'
+        response = service.format_error(service.APIError(message), req)
+        assert json.loads(response) == {
+            'request_id': None,
+            'error': message,
+        }
+
     def test_format_error_with_request_id(self):
         req = FakeRequest()
         service.set_request_id(req, 'req0')
@@ -254,6 +468,36 @@ class TestService(TestCase):
             'hello': 'world',
         }
 
+    @inlineCallbacks
+    def test_async_get_handler(self):
+        @service.service
+        class FooService(object):
+            @service.handler('/hello/<string:who>')
+            def hello(slf, request, who):
+                return deferLater(reactor, 0, lambda: {'hello': who})
+
+        client = yield self.listen(FooService())
+        resp = yield client.get('hello/world', {})
+        assert resp == {
+            'request_id': None,
+            'hello': 'world',
+        }
+
+    @inlineCallbacks
+    def test_async_get_handler_with_api_error(self):
+        @service.service
+        class FooService(object):
+            @service.handler('/hello/<string:who>')
+            def hello(slf, request, who):
+                return fail(service.APIError('teapot', 418))
+
+        client = yield self.listen(FooService())
+        resp = yield client.get('hello/world', {}, expected_code=418)
+        assert resp == {
+            'request_id': None,
+            'error': 'teapot',
+        }
+
     @inlineCallbacks
     def test_get_handler_with_api_error(self):
         @service.service
@@ -304,6 +548,45 @@ class TestService(TestCase):
             'error': "Internal error: Exception('oops',)",
         }
 
+    @inlineCallbacks
+    def test_custom_error_handler_in_subclass(self):
+        @service.service
+        class FooService(object):
+            @service.handler('/hello/<string:who>')
+            def hello(slf, request, who):
+                raise Exception('oops')
+
+        class BarService(FooService):
+            def handle_api_error(slf, failure, request):
+                raise service.APIError("Internal error: %r" % failure.value)
+
+        client = yield self.listen(BarService())
+        resp = yield client.get('hello/world', {}, expected_code=500)
+        assert resp == {
+            'request_id': None,
+            'error': "Internal error: Exception('oops',)",
+        }
+
+    @inlineCallbacks
+    def test_custom_error_handler_on_instance(self):
+        @service.service
+        class FooService(object):
+            @service.handler('/hello/<string:who>')
+            def hello(slf, request, who):
+                raise Exception('oops')
+
+        def handle_api_error(failure, request):
+            raise service.APIError("Internal error: %r" % failure.value)
+
+        foo_service = FooService()
+        foo_service.handle_api_error = handle_api_error
+        client = yield self.listen(foo_service)
+        resp = yield client.get('hello/world', {}, expected_code=500)
+        assert resp == {
+            'request_id': None,
+            'error': "Internal error: Exception('oops',)",
+        }
+
     @inlineCallbacks
     def test_simple_put_handler(self):
         @service.service
@@ -10,5 +10,5 @@ setup(
     author='Praekelt Foundation',
     author_email='dev@praekeltfoundation.org',
     packages=["aludel", "aludel.tests"],
-    install_requires=["Twisted", "klein", "sqlalchemy", "alchimia>=0.4"],
+    install_requires=["Twisted", "klein", "sqlalchemy", "alchimia>=0.4,<0.5"],
 )